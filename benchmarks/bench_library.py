@@ -0,0 +1,359 @@
+# -*- coding: utf-8 -*-
+# Benchmarks for the music library scanning stages of aspyplayer.
+#
+# Runs headless on a desktop Python 2 interpreter, using the stand-ins for
+# the PyS60 modules found in the standins directory. Synthetic corpora of
+# MP3 files are generated once per size and reused by later runs.
+#
+# Usage:
+#     python2 benchmarks/bench_library.py [--sizes 1000,10000,50000]
+#                                         [--stages scan,id3,rebuild,autocommit,musics,catalog,search,browse,browse-uncached]
+#                                         [--workers 2] [--workdir DIR]
+#
+# For each stage and corpus size the report shows files per second, bytes read
+# per file and the peak memory of the process running the stage. Each stage
+# runs in its own process, so the peak memory of one stage does not leak into
+# the next one.
+#
+# The rebuild stage writes the whole library in one transaction. The
+# autocommit stage saves the same files into an empty library with every
+# statement in its own transaction, to compare with it.
+#
+# The search stage saves the synthetic library rows to a database and runs
+# the SEARCHES against it; its files column is the number of searches run.
+#
+# The browse stages go through the artists and their albums of the same
+# database as a user would, going back to the albums of an artist after each
+# one. browse-uncached runs it without the DbHelper repeated queries cache, 
+# and their files column is the number of queries run.
+#
+# The musics and catalog stages do not read the corpus: they load the same
+# synthetic library rows as lists of Music objects and as a MusicCatalog, to
+# compare the memory used per track by the music windows.
+
+import os
+import random
+import resource
+import shutil
+import struct
+import subprocess
+import sys
+import time
+from optparse import OptionParser
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+SOURCE_DIR = os.path.join(os.path.dirname(BENCHMARKS_DIR), "src")
+
+ARTISTS = [u"Bloc Party", u"Mot\xf6rhead", u"Sigur R\xf3s", u"Bj\xf6rk", u"Caf\xe9 Tacvba",
+		u"東京事変", u"Сплин", u"Muse", u"Kasabian"]
+ALBUMS = [u"Silent Alarm", u"Ace of Spades", u"\xc1g\xe6tis byrjun", u"Homogenic", u"Re",
+		u"教育", u"Гранат", u"Absolution", u"Empire"]
+STAGES = ["scan", "id3", "rebuild", "autocommit", "musics", "catalog", "search", "browse", 
+		"browse-uncached"]
+MEMORY_STAGES = ["musics", "catalog", "search", "browse", "browse-uncached"]
+SEARCHES = [u"blo par", u"track 12", u"sil ala", u"mot", u"caf n", u"abs muse", u"t", u"homogenic"]
+
+# MPEG 1 layer III, 128 kbps, 44100 Hz, stereo
+FRAME_HEADER = "\xff\xfb\x90\x00"
+AUDIO_SIZE = 1024
+
+
+def load_aspyplayer():
+	sys.path.insert(0, os.path.join(BENCHMARKS_DIR, "standins"))
+	sys.path.insert(0, SOURCE_DIR)
+	import aspyplayer
+	return aspyplayer
+
+
+##########################################################
+######################### SYNTHETIC CORPUS
+
+def syncsafe(value):
+	return "".join([chr((value >> shift) & 0x7f) for shift in (21, 14, 7, 0)])
+
+def text_frame_v23(frame_id, text):
+	data = "\x01" + text.encode("utf_16")
+	return frame_id + struct.pack(">I", len(data)) + "\x00\x00" + data
+
+def text_frame_v24(frame_id, text):
+	data = "\x03" + text.encode("utf8")
+	return frame_id + syncsafe(len(data)) + "\x00\x00" + data
+
+def text_frame_v22(frame_id, text):
+	data = "\x00" + text.encode("latin1", "replace")
+	return frame_id + struct.pack(">I", len(data))[1:] + data
+
+def id3v2_tag(version, title, artist, album, number):
+	if version == 2:
+		frames = [text_frame_v22("TT2", title), text_frame_v22("TP1", artist),
+				text_frame_v22("TAL", album), text_frame_v22("TRK", unicode(number))]
+	elif version == 3:
+		frames = [text_frame_v23("TIT2", title), text_frame_v23("TPE1", artist),
+				text_frame_v23("TALB", album), text_frame_v23("TRCK", u"%i/12" % number),
+				text_frame_v23("TYER", u"2005"), text_frame_v23("COMM", u"bench")]
+	else:
+		frames = [text_frame_v24("TIT2", title), text_frame_v24("TPE1", artist),
+				text_frame_v24("TALB", album), text_frame_v24("TRCK", unicode(number)),
+				text_frame_v24("TDRC", u"2005-03-01")]
+
+	data = "".join(frames) + "\x00" * 256 # padding
+	return "ID3" + chr(version) + "\x00\x00" + syncsafe(len(data)) + data
+
+def id3v1_tag(title, artist, album, number):
+	def field(value, size):
+		return value.encode("latin1", "replace")[:size].ljust(size, "\x00")
+
+	return "TAG" + field(title, 30) + field(artist, 30) + field(album, 30) + "2005" + \
+			"\x00" * 28 + "\x00" + chr(number) + "\x00"
+
+def audio_data(vbr):
+	if vbr:
+		xing = "Xing" + struct.pack(">II", 1, 5000)
+		return FRAME_HEADER + "\x00" * 32 + xing + "\x00" * (AUDIO_SIZE - 48)
+
+	return FRAME_HEADER + "\x00" * (AUDIO_SIZE - 4)
+
+def music_file_content(rand, index):
+	artist = rand.choice(ARTISTS)
+	album = rand.choice(ALBUMS)
+	title = u"Track %i \xe0 %s" % (index, rand.choice(ALBUMS))
+	number = index % 12 + 1
+	kind = rand.random()
+
+	if kind < 0.4:
+		return id3v2_tag(3, title, artist, album, number) + audio_data(True)
+	elif kind < 0.6:
+		return id3v2_tag(4, title, artist, album, number) + audio_data(False)
+	elif kind < 0.7:
+		return id3v2_tag(2, title, artist, album, number) + audio_data(False)
+	elif kind < 0.9:
+		return audio_data(False) + id3v1_tag(title, artist, album, number)
+
+	return audio_data(False)
+
+def music_dir(rand, root):
+	# nesting from 1 to 6 levels, like Artist\Album\CD 1\...
+	depth = rand.randint(1, 6)
+	parts = [rand.choice(ARTISTS), rand.choice(ALBUMS)] + \
+			[u"D\xefsc %i" % rand.randint(1, 3) for i in range(depth)]
+	return os.path.join(root, *[part.encode("utf8") for part in parts[:depth]])
+
+def generate_corpus(root, count, seed=2008):
+	marker = os.path.join(root, ".complete")
+	if os.path.exists(marker):
+		return
+
+	shutil.rmtree(root, True)
+	rand = random.Random(seed)
+	for index in range(count):
+		dirname = music_dir(rand, root)
+		if not os.path.isdir(dirname):
+			os.makedirs(dirname)
+			# directories without music, like the ones found on the phone drives
+			open(os.path.join(dirname, "folder.jpg"), "wb").close()
+
+		name = u"%05i - Caf\xe9 n\xba%i.mp3" % (index, index)
+		f = open(os.path.join(dirname, name.encode("utf8")), "wb")
+		f.write(music_file_content(rand, index))
+		f.close()
+
+	open(marker, "w").close()
+
+
+##########################################################
+######################### STAGES
+
+class ReadCounter(object):
+	def __init__(self):
+		self.bytes_read = 0
+
+	def open(self, path, mode="r"):
+		return CountingFile(self, open(path, mode))
+
+
+class CountingFile(object):
+	def __init__(self, counter, f):
+		self.__counter = counter
+		self.__file = f
+
+	def read(self, size=-1):
+		data = self.__file.read(size)
+		self.__counter.bytes_read += len(data)
+		return data
+
+	def __getattr__(self, name):
+		return getattr(self.__file, name)
+
+
+def library_rows(count, seed=2008):
+	rand = random.Random(seed)
+	for index in xrange(count):
+		artist = rand.choice(ARTISTS)
+		album = rand.choice(ALBUMS)
+		path = u"E:\\Music\\%s\\%s\\%05i - Caf\xe9 n\xba%i.mp3" % (artist, album, index, index)
+		yield (path, u"Track %i \xe0 %s" % (index, album), artist, album, index % 12 + 1, 240)
+
+def load_musics(aspyplayer, count):
+	# the way the repository loaded the windows before the catalog
+	musics = []
+	for path, title, artist, album, number, length in library_rows(count):
+		music = aspyplayer.Music(path, False)
+		music.title = title
+		music.artist = artist
+		music.album = album
+		music.number = number
+		music.length = length
+		musics.append(music)
+	
+	return musics
+
+def save_library(aspyplayer, workdir, count):
+	db_path = os.path.join(workdir, "library_%i.db" % count)
+	if os.path.exists(db_path):
+		os.remove(db_path)
+	fs = aspyplayer.FileSystemServices([], [])
+	db_helper = aspyplayer.DbHelper(unicode(db_path), fs, aspyplayer.Sqlite3Backend())
+	repository = aspyplayer.MusicRepository(db_helper)
+	musics = load_musics(aspyplayer, count)
+	for music in musics:
+		music.year = music.comment = None
+		music.file_size = music.file_mtime = 0
+	repository.save_all(musics)
+	return db_helper, repository
+
+def search_library(aspyplayer, workdir, count):
+	db_helper, repository = save_library(aspyplayer, workdir, count)
+	
+	start = time.time()
+	searches = 0
+	for i in range(10):
+		for text in SEARCHES:
+			repository.search(text)
+			searches += 1
+	
+	db_helper.close()
+	return searches, time.time() - start
+
+def browse_library(aspyplayer, workdir, count):
+	db_helper, repository = save_library(aspyplayer, workdir, count)
+	
+	start = time.time()
+	queries = 0
+	for i in range(5):
+		for artist in ARTISTS:
+			albums = repository.find_all_albums_by_artist(artist)
+			queries += 1
+			for album in albums[:3]:
+				repository.find_all_musics_artist_album(artist, album)
+				repository.find_all_albums_by_artist(artist) # back to the albums
+				queries += 2
+	
+	db_helper.close()
+	return queries, time.time() - start
+
+def load_catalog(aspyplayer, count):
+	catalog = aspyplayer.MusicCatalog()
+	for row in library_rows(count):
+		catalog.append(*row)
+	
+	return catalog
+
+def peak_memory_kb():
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def run_stage(stage, corpus, workdir, workers, size):
+	aspyplayer = load_aspyplayer()
+	counter = ReadCounter()
+	aspyplayer.open = counter.open
+	fs = aspyplayer.FileSystemServices([corpus], [])
+
+	memory_before = peak_memory_kb()
+	start = time.time()
+
+	if stage == "scan":
+		files = 0
+		for path in fs.iter_all_files(corpus, ".mp3"):
+			files += 1
+	elif stage == "id3":
+		files = 0
+		for path in fs.iter_all_files(corpus, ".mp3"):
+			aspyplayer.Id3InfoReader(path)
+			files += 1
+	elif stage in ("rebuild", "autocommit"):
+		db_path = os.path.join(workdir, "bench.db")
+		if os.path.exists(db_path):
+			os.remove(db_path)
+		db_helper = aspyplayer.DbHelper(unicode(db_path), fs, aspyplayer.Sqlite3Backend())
+		tags_reader = aspyplayer.MusicTagsReader(workers)
+		repository = aspyplayer.MusicRepository(db_helper, tags_reader)
+		paths = fs.iter_all_files(corpus, ".mp3")
+		if stage == "autocommit":
+			files = tags_reader.read_all(paths, repository.save, repository.log_read_error)
+		else:
+			files = repository.rebuild_library(paths)
+		db_helper.close()
+	elif stage == "musics":
+		files = len(load_musics(aspyplayer, size))
+	elif stage == "catalog":
+		files = len(load_catalog(aspyplayer, size))
+	elif stage == "search":
+		files, search_elapsed = search_library(aspyplayer, workdir, size)
+	elif stage in ("browse", "browse-uncached"):
+		if stage == "browse-uncached":
+			aspyplayer.DbHelper.repeated_queries_size = 0
+		files, search_elapsed = browse_library(aspyplayer, workdir, size)
+	else:
+		raise ValueError("Unknown stage: %s" % stage)
+
+	elapsed = time.time() - start
+	if stage in ("search", "browse", "browse-uncached"):
+		elapsed = search_elapsed
+	print "%i %f %i %i" % (files, elapsed, counter.bytes_read, peak_memory_kb() - memory_before)
+
+def measure(stage, corpus, workdir, workers, size):
+	command = [sys.executable, os.path.abspath(__file__), "--run-stage", stage,
+			"--corpus", corpus, "--workdir", workdir, "--workers", str(workers),
+			"--sizes", str(size)]
+	output = subprocess.Popen(command, stdout=subprocess.PIPE, cwd=workdir).communicate()[0]
+	files, elapsed, bytes_read, memory_kb = output.split()[-4:]
+	return int(files), float(elapsed), int(bytes_read), int(memory_kb)
+
+
+##########################################################
+######################### PROGRAM ENTRY POINT
+
+def main():
+	parser = OptionParser()
+	parser.add_option("--sizes", default="1000,10000,50000")
+	parser.add_option("--stages", default=",".join(STAGES))
+	parser.add_option("--workers", type="int", default=2)
+	parser.add_option("--workdir", default=os.path.join("/tmp", "aspyplayer-bench"))
+	parser.add_option("--run-stage")
+	parser.add_option("--corpus")
+	options, args = parser.parse_args()
+
+	if not os.path.isdir(options.workdir):
+		os.makedirs(options.workdir)
+
+	if options.run_stage:
+		run_stage(options.run_stage, options.corpus, options.workdir, options.workers,
+				int(options.sizes))
+		return
+
+	stages = options.stages.split(",")
+	print "%-15s %8s %10s %12s %12s %14s %14s" % ("stage", "files", "seconds", "files/sec",
+											"bytes/file", "peak mem (KB)", "mem/file (B)")
+	for size in [int(size) for size in options.sizes.split(",")]:
+		corpus = os.path.join(options.workdir, "corpus_%i" % size)
+		if [stage for stage in stages if stage not in MEMORY_STAGES]:
+			generate_corpus(corpus, size)
+
+		for stage in stages:
+			files, elapsed, bytes_read, memory_kb = measure(stage, corpus, options.workdir,
+															options.workers, size)
+			print "%-15s %8i %10.2f %12.0f %12.0f %14i %14.0f" % (stage, files, elapsed,
+						files / max(elapsed, 1e-6), float(bytes_read) / max(files, 1), memory_kb,
+						memory_kb * 1024.0 / max(files, 1))
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,51 @@
+# Headless stand-in for the PyS60 appuifw module, used by the benchmarks.
+
+class Application(object):
+	def __init__(self):
+		self.body = None
+		self.menu = []
+		self.title = u""
+		self.screen = "normal"
+		self.exit_key_handler = None
+
+	def full_name(self):
+		return u"python"
+
+	def set_exit(self):
+		pass
+
+
+app = Application()
+
+def note(text, type="info"):
+	pass
+
+def query(label, type):
+	return None
+
+
+class Listbox(object):
+	def __init__(self, items, handler):
+		self.items = items
+		self.handler = handler
+		self.index = 0
+
+	def set_list(self, items, current=0):
+		self.items = items
+		self.index = current
+
+	def current(self):
+		return self.index
+
+	def bind(self, key_code, handler):
+		pass
+
+
+class Canvas(object):
+	def __init__(self, redraw_callback=None):
+		pass
+
+
+class Text(object):
+	def set(self, text):
+		pass
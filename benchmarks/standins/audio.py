@@ -0,0 +1,12 @@
+# Headless stand-in for the PyS60 audio module, used by the benchmarks.
+
+ENotReady = 0
+EOpen = 1
+EPlaying = 2
+
+
+class Sound(object):
+	def open(path):
+		raise IOError("No audio device: %s" % path)
+
+	open = staticmethod(open)
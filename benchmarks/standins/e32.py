@@ -0,0 +1,32 @@
+# Headless stand-in for the PyS60 e32 module, used by the benchmarks.
+
+import time
+
+
+class Ao_timer(object):
+	def after(self, seconds, callback=None):
+		time.sleep(seconds)
+		if callback:
+			callback()
+
+	def cancel(self):
+		pass
+
+
+class Ao_lock(object):
+	def wait(self):
+		pass
+
+	def signal(self):
+		pass
+
+def ao_yield():
+	pass
+
+def ao_sleep(seconds, callback=None):
+	time.sleep(seconds)
+	if callback:
+		callback()
+
+def ao_callgate(function):
+	return function
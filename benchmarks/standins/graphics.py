@@ -0,0 +1,11 @@
+# Headless stand-in for the PyS60 graphics module, used by the benchmarks.
+
+FONT_BOLD = 1
+FONT_ANTIALIAS = 16
+
+
+class Image(object):
+	def open(path):
+		return Image()
+
+	open = staticmethod(open)
@@ -0,0 +1,7 @@
+# Headless stand-in for the PyS60 key_codes module, used by the benchmarks.
+
+EKeyLeftArrow = 63495
+EKeyRightArrow = 63496
+EKeyUpArrow = 63497
+EKeyDownArrow = 63498
+EKeySelect = 63557
@@ -1,3 +1,4 @@
+# -*- coding: latin-1 -*-
 # Author: Douglas Fernando da Silva - doug.fernando at gmail.com
 # Copyright 2008
 # 
@@ -13,40 +14,77 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from __future__ import generators
+
 __version__ = "0.1.5 beta"
 
+from array import array
 from random import shuffle
 from key_codes import EKeyLeftArrow, EKeyRightArrow, EKeyUpArrow, EKeyDownArrow, EKeySelect 
 
 import appuifw
 import audio
+import binascii
 import e32
-import e32db
+import fnmatch
+import httplib
 import md5
 import os
+import re
 import time
 import urllib
+import urlparse
 import socket
 import sys
 import graphics
+import thread
 import traceback
 
+try:
+	import e32db
+except ImportError:
+	e32db = None
+
+try:
+	import sqlite3
+except ImportError:
+	sqlite3 = None
+
 ##########################################################
 ######################### DOMAIN MODEL 
 
 class Id3InfoReader(object):
+	v2_frame_fields = {
+		2: {"TT2": "title", "TP1": "artist", "TAL": "album", 
+			"TRK": "number", "TYE": "year", "TLE": "length"},
+		3: {"TIT2": "title", "TPE1": "artist", "TALB": "album", 
+			"TRCK": "number", "TYER": "year", "TLEN": "length"},
+		4: {"TIT2": "title", "TPE1": "artist", "TALB": "album", 
+			"TRCK": "number", "TYER": "year", "TDRC": "year", "TLEN": "length"}
+	}
+
 	def __init__(self, file_path):
 		self.file_path = file_path
 		version_marker, fp = self.init_file(self.file_path)
 		
-		if version_marker == "TAG":
+		if version_marker == "ID3":
+			self.read_v2(fp)
+		elif version_marker == "TAG":
 			self.read_v1(fp)
 		else:
-			self.read_v2(fp)
+			self.read_no_tag(fp)
 
 	def init_file(self, path):
 		path = self.file_path.encode("utf8")
-		fp = open(path, "r")
+		file_info = os.stat(path)
+		self.file_size = file_info.st_size
+		self.file_mtime = int(file_info.st_mtime)
+		
+		fp = open(path, "rb")
+		self.header = fp.read(10)
+		if self.header[:3] == "ID3":
+			return ("ID3", fp)
+		
 		fp.seek(-128, 2)
 		marker = fp.read(3)
 		
@@ -81,9 +119,138 @@ class Id3InfoReader(object):
 			self.number = -1
 			self.comment = UnicodeHelper.safe_unicode(self.remove_X00(comment))
 		
+		self.length = MpegInfoReader(fp, 0, self.file_size - 128).length
 		fp.close()
 	
 	def read_v2(self, fp):
+		major_version = ord(self.header[3])
+		flags = ord(self.header[5])
+		tag_size = self.syncsafe_to_int(self.header[6:10])
+		frames = {}
+		
+		if self.v2_frame_fields.has_key(major_version):
+			# the whole tag is read at once, the frames are parsed from memory
+			data = fp.read(tag_size)
+			if flags & 0x80 and major_version < 4:
+				data = self.remove_unsynchronisation(data)
+			frames = self.read_v2_frames(data, major_version, flags)
+		
+		audio_start = 10 + tag_size
+		if major_version == 4 and flags & 0x10: # footer
+			audio_start += 10
+		mpeg_info = MpegInfoReader(fp, audio_start, self.file_size - audio_start)
+		fp.close()
+		
+		self.title = frames.get("title") or self.file_path_to_title()
+		self.artist = frames.get("artist") or u"Unknown"
+		self.album = frames.get("album") or u"Unknown"
+		self.year = frames.get("year")
+		if self.year: 
+			self.year = self.year[:4]
+		self.comment = None
+		self.number = self.text_to_number(frames.get("number"))
+		self.length = self.text_to_number(frames.get("length"), 0) / 1000
+		if mpeg_info.from_vbr_header or not self.length:
+			self.length = mpeg_info.length
+	
+	def read_v2_frames(self, data, major_version, flags):
+		frame_fields = self.v2_frame_fields[major_version]
+		missing = {}
+		for field in frame_fields.values():
+			missing[field] = True
+
+		if major_version == 2:
+			id_length, header_length = 3, 6
+		else:
+			id_length, header_length = 4, 10
+		
+		pos = 0
+		if flags & 0x40:
+			if major_version == 2: # compressed tag, not supported
+				return {}
+			elif major_version == 3:
+				pos = self.bytes_to_int(data[:4]) + 4
+			else:
+				pos = self.syncsafe_to_int(data[:4])
+		
+		result = {}
+		while missing and pos + header_length <= len(data):
+			frame_id = data[pos:pos + id_length]
+			if frame_id[0] == "\x00": # padding
+				break
+			
+			frame_flags = 0
+			if major_version == 2:
+				frame_size = self.bytes_to_int(data[pos + 3:pos + 6])
+			elif major_version == 3:
+				frame_size = self.bytes_to_int(data[pos + 4:pos + 8])
+				frame_flags = self.bytes_to_int(data[pos + 8:pos + 10])
+			else:
+				frame_size = self.syncsafe_to_int(data[pos + 4:pos + 8])
+				frame_flags = self.bytes_to_int(data[pos + 8:pos + 10])
+			
+			pos += header_length
+			frame_data = data[pos:pos + frame_size]
+			pos += frame_size
+			
+			field = frame_fields.get(frame_id)
+			if not field or not missing.has_key(field):
+				continue
+			
+			frame_data = self.prepare_v2_frame_data(frame_data, major_version, frame_flags)
+			if frame_data is None:
+				continue
+			
+			value = self.decode_v2_text(frame_data)
+			if value:
+				result[field] = value
+				del missing[field]
+		
+		return result
+
+	def prepare_v2_frame_data(self, frame_data, major_version, frame_flags):
+		if major_version == 3:
+			if frame_flags & 0x00c0: # compressed or encrypted
+				return None
+			if frame_flags & 0x0020: # group identifier
+				frame_data = frame_data[1:]
+		elif major_version == 4:
+			if frame_flags & 0x000c: # compressed or encrypted
+				return None
+			if frame_flags & 0x0040: # group identifier
+				frame_data = frame_data[1:]
+			if frame_flags & 0x0002:
+				frame_data = self.remove_unsynchronisation(frame_data)
+			if frame_flags & 0x0001: # data length indicator
+				frame_data = frame_data[4:]
+		
+		return frame_data
+
+	def decode_v2_text(self, frame_data):
+		if not frame_data:
+			return u""
+		
+		encoding = ord(frame_data[0])
+		text = frame_data[1:]
+		try:
+			if encoding == 1 or encoding == 2:
+				text = text[:len(text) - len(text) % 2]
+				if encoding == 1:
+					value = text.decode("utf_16")
+				else:
+					value = text.decode("utf_16_be")
+			elif encoding == 3:
+				value = text.decode("utf8")
+			else:
+				value = UnicodeHelper.safe_unicode(text)
+		except UnicodeError:
+			value = UnicodeHelper.safe_unicode(text)
+		
+		return value.split(u"\x00")[0]
+
+	def read_no_tag(self, fp):
+		self.length = MpegInfoReader(fp, 0, self.file_size).length
+		fp.close()
 		self.title = self.file_path_to_title()
 		self.artist = u"Unknown"
 		self.album = u"Unknown"
@@ -91,18 +258,152 @@ class Id3InfoReader(object):
 		self.comment = None
 		self.number = -1
 	
+	def text_to_number(self, value, default=-1):
+		try:
+			return int(value.split(u"/")[0])
+		except (AttributeError, ValueError):
+			return default
+	
+	def bytes_to_int(self, data):
+		result = 0
+		for byte in data:
+			result = (result << 8) + ord(byte)
+		return result
+	
+	def syncsafe_to_int(self, data):
+		result = 0
+		for byte in data:
+			result = (result << 7) + (ord(byte) & 0x7f)
+		return result
+	
+	def remove_unsynchronisation(self, data):
+		return data.replace("\xff\x00", "\xff")
+	
 	def remove_X00(self, value):
 		return value.replace("\x00", "")
 
 
+class MpegInfoReader(object):
+	# bitrates in kbps by (MPEG 1, layer) and (MPEG 2/2.5, layer)
+	bitrates = {
+		(1, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+		(1, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+		(1, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+		(2, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+		(2, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+		(2, 3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160]
+	}
+	sample_rates = {1: [44100, 48000, 32000], 2: [22050, 24000, 16000], 2.5: [11025, 12000, 8000]}
+	versions = {0: 2.5, 2: 2, 3: 1}
+	layers = {1: 3, 2: 2, 3: 1}
+	read_size = 4096
+
+	def __init__(self, fp, audio_start, audio_size):
+		self.length = 0
+		self.from_vbr_header = False
+		
+		fp.seek(audio_start)
+		data = fp.read(self.read_size)
+		
+		pos = self.find_frame_header(data)
+		if pos >= 0:
+			self.read_frame(data, pos, audio_size - pos)
+
+	def find_frame_header(self, data):
+		pos = data.find("\xff")
+		while 0 <= pos <= len(data) - 4:
+			if self.parse_header(data[pos:pos + 4]):
+				return pos
+			pos = data.find("\xff", pos + 1)
+		
+		return -1
+
+	def parse_header(self, header):
+		value = (ord(header[0]) << 24) | (ord(header[1]) << 16) | (ord(header[2]) << 8) | ord(header[3])
+		if (value >> 21) & 0x7ff != 0x7ff:
+			return None
+		
+		version = self.versions.get((value >> 19) & 3)
+		layer = self.layers.get((value >> 17) & 3)
+		bitrate_index = (value >> 12) & 0xf
+		sample_rate_index = (value >> 10) & 3
+		if not version or not layer or bitrate_index in (0, 15) or sample_rate_index == 3:
+			return None
+		
+		if version == 1:
+			bitrate = self.bitrates[(1, layer)][bitrate_index]
+		else:
+			bitrate = self.bitrates[(2, layer)][bitrate_index]
+		
+		if layer == 1:
+			samples_per_frame = 384
+		elif layer == 3 and version != 1:
+			samples_per_frame = 576
+		else:
+			samples_per_frame = 1152
+		
+		mono = ((value >> 6) & 3) == 3
+		return (version, layer, bitrate, self.sample_rates[version][sample_rate_index], 
+				samples_per_frame, mono)
+
+	def read_frame(self, data, pos, audio_size):
+		version, layer, bitrate, sample_rate, samples_per_frame, mono = self.parse_header(data[pos:pos + 4])
+		
+		frames_count = 0
+		if layer == 3:
+			frames_count = self.read_xing_frames(data, pos, version, mono) or \
+							self.read_vbri_frames(data, pos)
+		
+		if frames_count:
+			self.length = frames_count * samples_per_frame / sample_rate
+			self.from_vbr_header = True
+		elif audio_size > 0:
+			self.length = audio_size * 8 / (bitrate * 1000)
+
+	def read_xing_frames(self, data, pos, version, mono):
+		# the Xing/Info header follows the side information of the first frame
+		if version == 1:
+			side_info_size = mono and 17 or 32
+		else:
+			side_info_size = mono and 9 or 17
+		
+		offset = pos + 4 + side_info_size
+		if data[offset:offset + 4] not in ("Xing", "Info"):
+			return 0
+		
+		flags = self.bytes_to_int(data[offset + 4:offset + 8])
+		if not flags & 1:
+			return 0
+		
+		return self.bytes_to_int(data[offset + 8:offset + 12])
+
+	def read_vbri_frames(self, data, pos):
+		offset = pos + 36
+		if data[offset:offset + 4] != "VBRI":
+			return 0
+		
+		return self.bytes_to_int(data[offset + 14:offset + 18])
+
+	def bytes_to_int(self, data):
+		result = 0
+		for byte in data:
+			result = (result << 8) + ord(byte)
+		return result
+
+
 class Music(object):
-	def __init__(self, file_path=""):
+	file_fields = ("title", "artist", "album", "year", "comment", "number", "length", 
+				"file_size", "file_mtime")
+
+	def __init__(self, file_path="", read_tags=True):
 		self.file_path = UnicodeHelper.safe_unicode(file_path);
-		self.init_music()
-		self.player = MusicPlayer(self)
-		self.length = 0
+		if read_tags:
+			self.init_music()
+		self.player = None
 		self.music_brainz_ID = ""
 		self.played_at = 0
+		self.history_id = None
+		self.journal_seq = None
 		self.position = 0
 		self.now_playing_sent = False
 		self.__logger = LogFactory.create_for(self.__class__.__name__)
@@ -116,6 +417,9 @@ class Music(object):
 			self.year = id3_reader.year
 			self.comment = id3_reader.comment
 			self.number = id3_reader.number
+			self.length = id3_reader.length
+			self.file_size = id3_reader.file_size
+			self.file_mtime = id3_reader.file_mtime
 		else:
 			self.title = None
 			self.artist = None
@@ -123,33 +427,63 @@ class Music(object):
 			self.year = None
 			self.comment = None
 			self.number = -1
+			self.length = 0
+			self.file_size = 0
+			self.file_mtime = 0
+
+	def __getattr__(self, name):
+		# musics loaded from the database only read the file when a tag is missing
+		if name in Music.file_fields:
+			self.init_music()
+			return self.__dict__[name]
+		
+		raise AttributeError(name)
 
 	def __str__(self):
 		return u"  Artist: %s\n  Title: %s\n" % (self.artist, self.title)
 
+	def get_player(self):
+		if not self.player:
+			self.player = MusicPlayer(self)
+		
+		return self.player
+
 	def play(self, callback):
-		self.player.play(callback)
+		self.get_player().play(callback)
 		self.__logger.debug("Playing: %s" % self.title)
 	
 	def stop(self):
-		self.player.stop()
+		if self.player:
+			self.player.stop()
 		
 	def pause(self):	
-		self.player.pause()
+		if self.player:
+			self.player.pause()
 		
 	def volume_up(self):
-		self.player.volume_up()
+		if self.player:
+			self.player.volume_up()
 
 	def volume_down(self):
-		self.player.volume_down()
+		if self.player:
+			self.player.volume_down()
 
 	def is_playing(self):
+		if not self.player:
+			return False
+		
 		return self.player.is_playing()
 
 	def is_loading(self):
+		if not self.player:
+			return False
+		
 		return self.player.is_loading()
 
 	def get_player_position_in_seconds(self):
+		if not self.player:
+			return 0
+		
 		return int(self.player.current_position() / 1e6)
 
 	def can_update_position(self):
@@ -188,6 +522,9 @@ class Music(object):
 			return unicode("%02i:%02i" % (minutes, seconds))
 	
 	def get_status_formatted(self):
+		if not self.player:
+			return "Stopped"
+		
 		return self.player.get_status_formatted() 
 
 	def played_at_formatted(self):
@@ -207,6 +544,93 @@ class Music(object):
 			return unicode(str(self.number))
 
 
+class InternedValues(object):
+	def __init__(self):
+		self.values = []
+		self.__ids = {}
+
+	def get_id(self, value):
+		if not self.__ids.has_key(value):
+			self.__ids[value] = len(self.values)
+			self.values.append(value)
+		
+		return self.__ids[value]
+
+
+class MusicCatalog(object):
+	# parallel columns instead of Music objects, which are created only when accessed
+	def __init__(self):
+		self.__dirs = InternedValues()
+		self.__artists = InternedValues()
+		self.__albums = InternedValues()
+		self.__dir_ids = array("i")
+		self.__file_names = []
+		self.__titles = []
+		self.__artist_ids = array("i")
+		self.__album_ids = array("i")
+		self.__numbers = array("i")
+		self.__lengths = array("i")
+		self.__order = array("i")
+
+	def append(self, path, title, artist, album, number=-1, length=0):
+		dirname, file_name = os.path.split(path)
+		if number is None: number = -1
+		if length is None: length = 0
+
+		self.__order.append(len(self.__file_names))
+		self.__dir_ids.append(self.__dirs.get_id(dirname))
+		self.__file_names.append(file_name.encode("utf8"))
+		self.__titles.append(UnicodeHelper.safe_unicode(title or u"").encode("utf8"))
+		self.__artist_ids.append(self.__artists.get_id(artist))
+		self.__album_ids.append(self.__albums.get_id(album))
+		self.__numbers.append(int(number))
+		self.__lengths.append(int(length))
+
+	def append_music(self, music):
+		self.append(music.file_path, music.title, music.artist, music.album, music.number, 
+				music.length)
+
+	def __len__(self):
+		return len(self.__order)
+
+	def __getitem__(self, index):
+		i = self.__order[index]
+		music = Music(os.path.join(self.__dirs.values[self.__dir_ids[i]], 
+				self.__file_names[i].decode("utf8")), False)
+		music.title = self.__titles[i].decode("utf8")
+		music.artist = self.__artists.values[self.__artist_ids[i]]
+		music.album = self.__albums.values[self.__album_ids[i]]
+		music.number = self.__numbers[i]
+		music.length = self.__lengths[i]
+		return music
+
+	def title(self, index):
+		return self.__titles[self.__order[index]].decode("utf8")
+
+	def number(self, index):
+		return self.__numbers[self.__order[index]]
+
+	def title_key(title):
+		# case insensitive, the titles made from the file names, starting with "..", last
+		if title.startswith(".."):
+			return u"1" + title.upper()
+		return u"0" + title.upper()
+
+	title_key = staticmethod(title_key)
+
+	def sort_by_title(self):
+		decorated = []
+		for i in self.__order:
+			decorated.append((self.title_key(self.__titles[i].decode("utf8")), i))
+		decorated.sort()
+		self.__order = array("i", [item[1] for item in decorated])
+
+	def sort_by_number(self):
+		decorated = [(self.__numbers[i], i) for i in self.__order]
+		decorated.sort()
+		self.__order = array("i", [item[1] for item in decorated])
+
+
 class MusicPlayer(object):
 	current_volume = -1
 
@@ -321,16 +745,20 @@ class MusicList(object):
 		self.is_new = True
 
 		if musics:
-			self.__linear_musics = musics
-			self.__random_musics = musics[:]
-			shuffle(self.__random_musics)
+			# only the playing order is kept here, the musics are created from the 
+			# source (a list or a MusicCatalog) when they are reached
+			self.__source = musics
+			self.__linear_order = array("i", range(len(musics)))
+			random_order = range(len(musics))
+			shuffle(random_order)
+			self.__random_order = array("i", random_order)
 		
 			if random: 
-				self.__musics = self.__random_musics
+				self.__musics = self.__random_order
 			else:
-				self.__musics = self.__linear_musics
+				self.__musics = self.__linear_order
 			
-			self.current_music = self.__musics[0]
+			self.current_music = self.get_music(0)
 			
 			self.log_music_list()
 		else:
@@ -339,10 +767,14 @@ class MusicList(object):
 	def log_music_list(self):
 		if self.__logger.debug_enabled():
 			self.__logger.debug("Music list:")
-			for music in self.__musics:
+			for i in range(len(self.__musics)):
+				music = self.get_music(i)
 				self.__logger.debug("\t%s-%s" % (music.number, music.title))
 			self.__logger.debug("----")
 	
+	def get_music(self, index):
+		return self.__source[self.__musics[index]]
+
 	def is_empty(self):
 		return len(self.__musics) < 1
 
@@ -371,7 +803,7 @@ class MusicList(object):
 	
 	def set_current_index(self, index):
 		self.__current_index = index
-		self.current_music = self.__musics[self.__current_index]
+		self.current_music = self.get_music(self.__current_index)
 	
 	def play_current_music(self):
 		added_to_history = False;
@@ -435,7 +867,7 @@ class MusicList(object):
 		last_index = len(self.__musics) - 1
 		if self.__current_index < last_index:
 			self.__current_index = self.__current_index + 1
-			self.current_music = self.__musics[self.__current_index]
+			self.current_music = self.get_music(self.__current_index)
 			return True
 	
 		return False
@@ -443,7 +875,7 @@ class MusicList(object):
 	def move_previous(self):
 		if self.__current_index > 0:
 			self.__current_index = self.__current_index - 1
-			self.current_music = self.__musics[self.__current_index]
+			self.current_music = self.get_music(self.__current_index)
 			return True
 		
 		return False
@@ -454,9 +886,9 @@ class MusicList(object):
 	def update_playing_mode_if_necessary(self):
 		if self.__update_play_mode:
 			if not self.__random:
-				self.__musics = self.__linear_musics
+				self.__musics = self.__linear_order
 			else:
-				self.__musics = self.__random_musics
+				self.__musics = self.__random_order
 	
 			self.__update_play_mode = False
 
@@ -466,44 +898,57 @@ class MusicList(object):
 
 
 class MusicHistory(object):
-	def __init__(self, repository, audio_scrobbler_service):
-		self.__batch_size = 50
+	compact_size = 10
+
+	def __init__(self, repository, journal=None):
 		self.__repository = repository
-		self.__audio_scrobbler_service = audio_scrobbler_service
+		self.__journal = journal
 
 	def add_music(self, music):
-		self.__repository.save_music(music)
+		if not self.__journal:
+			self.__repository.save_music(music)
+			return
+		
+		if self.__journal.next_seq is None:
+			self.compact_journal() # the plays are numbered after the ones already saved
+		self.__journal.append(music)
+		if self.__journal.pending >= self.compact_size:
+			self.compact_journal()
+	
+	def compact_journal(self):
+		# also recovers the plays journaled before a crash, the ones already 
+		# saved are skipped by their sequence number
+		if not self.__journal:
+			return 0
+		
+		musics = self.__journal.read_all()
+		count = 0
+		if musics:
+			count = self.__repository.save_new_musics(musics)
+		self.__journal.truncate()
+		self.__journal.next_seq = self.__repository.get_last_journal_seq() + 1
+		return count
+	
+	def load_all_history(self):
+		self.compact_journal()
+		return self.__repository.load_all_history()
+	
+	def load_history_after(self, history_id):
+		self.compact_journal()
+		return self.__repository.load_history_after(history_id)
+	
+	def remove_sent(self, musics):
+		self.__repository.remove_musics(musics)
 	
 	def clear(self):
 		self.__repository.clear_history()
+		if self.__journal:
+			self.__journal.truncate()
 	
-	def send_to_audioscrobbler(self):
-		musics = self.__repository.load_all_history()
-		musics.sort(lambda m1, m2: cmp(m1.played_at, m2.played_at))
-		if musics and len(musics) < self.__batch_size:
-			if self.__audio_scrobbler_service.send(musics):
-				self.clear()
-		elif musics:
-			self.send_batches_to_audioscrobbler(musics)
-
-	def send_batches_to_audioscrobbler(self, musics):
-		assert len(musics) >= self.__batch_size
-		
-		num_full_batches = len(musics) / self.__batch_size
-		for i in range(num_full_batches):
-			start = i * self.__batch_size
-			end = start + self.__batch_size
-			batch = musics[start:end]
-			self.send_batch(batch)
-		
-		remainings = len(musics) % self.__batch_size
-		if remainings > 0:
-			batch = musics[len(musics)-remainings:len(musics)]
-			self.send_batch(batch)
-		
-	def send_batch(self, musics_batch):
-		if self.__audio_scrobbler_service.send(musics_batch):
-			self.__repository.remove_musics(musics_batch)
+	def close(self):
+		self.compact_journal()
+		if self.__journal:
+			self.__journal.close()
 
 
 class AudioScrobblerUser(object):
@@ -518,134 +963,541 @@ class AudioScrobblerUser(object):
 ######################### REPOSITORIES 
 
 class MusicRepository(object):
-	def __init__(self, db_helper):
+	music_columns = "Path, Title, Artist, Album, Year, Comment, TrackNumber, TrackLength"
+
+	def __init__(self, db_helper, tags_reader=None):
 		self.__db_helper = db_helper
+		self.__tags_reader = tags_reader
+		if not self.__tags_reader:
+			self.__tags_reader = MusicTagsReader()
+		self.__artists = NameRepository(db_helper, "Artist")
+		self.__albums = NameRepository(db_helper, "Album")
+		self.__search_index = SearchIndexRepository(db_helper)
+		self.__listings = DirectoryListingCache()
+		self.__missing = {}
+		self.__stats = None
+		self.__stats_saved = True
 		self.__logger = LogFactory.create_for(self.__class__.__name__)
 
 	def exists(self, path):
-		return os.path.exists(path.encode("utf8"))
+		if self.__listings.exists(path):
+			return True
+		
+		# the musics of a directory that cannot be read, e.g. on a removed 
+		# memory card, are hidden but not taken as missing
+		if self.__listings.is_listed(path):
+			self.__missing[path] = True
+		return False
+
+	def count_missing(self):
+		return len(self.__missing)
+
+	def forget_missing(self):
+		self.__missing = {}
+
+	def prune_missing(self):
+		# musics found missing while the lists were loaded are deleted together
+		missing = self.__missing.keys()
+		if missing:
+			self.__logger.debug("Removing %i missing musics from the library" % len(missing))
+			self.delete_all(missing)
+			self.__missing = {}
+		
+		return len(missing)
 
 	def distinct(self, collection):
 		result = []
+		seen = {}
 		for item in collection:
-			if item not in result:
+			if not seen.has_key(item):
+				seen[item] = True
 				result.append(item)
 		
 		return result
 		
 	def count_all(self):
-		cmd = "SELECT Path FROM Music"
-		rows = self.__db_helper.execute_reader(cmd)
-		return len(rows)
+		return self.get_stats()[0]
 	
 	def count_all_artists(self):
-		return len(self.find_all_artists())
+		return self.get_stats()[1]
 	
 	def count_all_albums(self):
-		return len(self.find_all_albums())
+		return self.get_stats()[2]
+
+	def get_stats(self):
+		# (musics, artists, albums), read from the snapshot saved with the library
+		if self.__stats is None:
+			rows = self.__db_helper.execute_reader(
+						"SELECT Musics, Artists, Albums FROM Library_Stats")
+			if rows:
+				self.__stats = tuple(rows[0])
+				self.__stats_saved = True
+			else:
+				self.update_stats()
+		
+		return self.__stats
+
+	def update_stats(self):
+		# artists and albums without musics are removed in the same pass
+		rows = self.__db_helper.cursor("SELECT Path, ArtistId, AlbumId FROM Music")
+		paths, artists, albums = {}, {}, {}
+		for row in rows:
+			paths[row[0]] = True
+			artists[row[1]] = True
+			albums[row[2]] = True
+		self.__artists.delete_unused(artists)
+		self.__albums.delete_unused(albums)
+		self.__stats = (len(paths), len(artists), len(albums))
+		
+		self.__db_helper.execute_nonquery("DELETE FROM Library_Stats")
+		cmd = "INSERT INTO Library_Stats (Musics, Artists, Albums) VALUES(?, ?, ?)"
+		self.__db_helper.execute_nonquery(cmd, self.__stats)
+		self.__stats_saved = True
+
+	def invalidate_stats(self):
+		# the snapshot is deleted once, not on every insert of a library scan
+		self.__stats = None
+		if self.__stats_saved:
+			self.__db_helper.execute_nonquery("DELETE FROM Library_Stats")
+			self.__stats_saved = False
 	
+	def create_musics(self, rows, catalog=None):
+		if catalog is None:
+			catalog = MusicCatalog()
+		self.__listings.start()
+		for row in rows:
+			if not self.exists(row[0]):
+				continue
+			if row[1]:
+				catalog.append(row[0], row[1], row[2], row[3], row[6], row[7])
+			else: # rows saved before the tags were cached read them from the file
+				music = Music(row[0])
+				music.artist = row[2]
+				music.album = row[3]
+				catalog.append_music(music)
+		
+		return catalog
+
 	def find_all(self):
-		cmd = "SELECT Path FROM Music"
-		rows = self.__db_helper.execute_reader(cmd)
-		result = [Music(row[0]) for row in rows if self.exists(row[0])]
-		return self.distinct(result)
+		cmd = "SELECT %s FROM Music ORDER BY Path" % self.music_columns
+		return self.create_musics(self.distinct_paths(self.__db_helper.cursor(cmd)))
+
+	def find_page_by_title(self, catalog, after=None, size=50):
+		# DBMS SQL has no LIMIT/OFFSET: after is the key returned for the previous 
+		# page, None is returned after the last one and a size of None reads the rest. 
+		# The order is the one of MusicCatalog.sort_by_title, kept in TitleKey.
+		cmd = "SELECT %s, TitleKey FROM Music" % self.music_columns
+		params = ()
+		if after:
+			title_key, path = after
+			if title_key is None: # rows saved before the tags were cached
+				cmd += " WHERE (TitleKey IS NULL AND Path > ?) OR TitleKey IS NOT NULL"
+				params = (path,)
+			else:
+				cmd += " WHERE TitleKey > ? OR (TitleKey = ? AND Path > ?)"
+				params = (title_key, title_key, path)
+		cmd += " ORDER BY TitleKey, Path"
+		
+		cursor = self.__db_helper.cursor(cmd, params)
+		if size is None:
+			self.create_musics(self.distinct_paths(cursor), catalog)
+			return None
+		
+		rows = cursor.fetch_many(size)
+		self.create_musics(self.distinct_paths(rows), catalog)
+		if len(rows) < size:
+			return None
+		
+		return (rows[-1][8], rows[-1][0])
 
 	def find_all_musics_path(self):
-		cmd = "SELECT Path FROM Music"
-		rows = self.__db_helper.execute_reader(cmd)
-		result = [row[0] for row in rows]
-		return self.distinct(result)
+		cmd = "SELECT Path FROM Music ORDER BY Path"
+		for row in self.distinct_paths(self.__db_helper.cursor(cmd)):
+			yield row[0]
+
+	def distinct_paths(self, rows):
+		# the rows are ordered by path, so a repeated path comes right after the first
+		last_path = None
+		for row in rows:
+			if row[0] != last_path:
+				last_path = row[0]
+				yield row
 
 	def find_all_artists(self):
-		cmd = "SELECT Artist FROM Music"
-		rows = self.__db_helper.execute_reader(cmd)
-		result = [row[0] for row in rows]
-		return self.distinct(result)
+		self.get_stats() # removes the artists left without musics
+		return self.__artists.find_all_names()
 
 	def find_all_albums(self):
-		cmd = "SELECT Album FROM Music"
-		rows = self.__db_helper.execute_reader(cmd)
-		result = [row[0] for row in rows]
-		return self.distinct(result)
+		self.get_stats()
+		return self.__albums.find_all_names()
 
 	def find_all_albums_by_artist(self, artist):
-		cmd = "SELECT Album FROM Music WHERE Artist = '%s'" % artist.replace("'", "''")
-		rows = self.__db_helper.execute_reader(cmd)
-		result = [row[0] for row in rows]
-		return self.distinct(result)
+		artist_id = self.__artists.get_id(artist)
+		if artist_id is None:
+			return []
+		
+		cmd = "SELECT AlbumId FROM Music WHERE ArtistId = ?"
+		rows = self.__db_helper.execute_reader(cmd, (artist_id,))
+		album_ids = self.distinct([row[0] for row in rows])
+		return [self.__albums.get_name(album_id) for album_id in album_ids]
 
 	def find_all_musics_artist_album(self, artist, album):
-		cmd = "SELECT Path FROM Music WHERE Album = '%s' AND Artist = '%s'" % (
-										album.replace("'", "''"), artist.replace("'", "''"))
-		rows = self.__db_helper.execute_reader(cmd)
-		result = [Music(row[0]) for row in rows if self.exists(row[0])]
-		return result
+		artist_id = self.__artists.get_id(artist)
+		album_id = self.__albums.get_id(album)
+		if artist_id is None or album_id is None:
+			return MusicCatalog()
+		
+		cmd = "SELECT %s FROM Music WHERE ArtistId = ? AND AlbumId = ?" % self.music_columns
+		rows = self.__db_helper.execute_reader(cmd, (artist_id, album_id))
+		return self.create_musics(rows)
 	
 	def find_all_by_artist(self, artist):
-		cmd = "SELECT Path FROM Music WHERE Artist = '%s'" % artist.replace("'", "''")
-		rows = self.__db_helper.execute_reader(cmd)
-		result = [Music(row[0]) for row in rows if self.exists(row[0])]
-		return result
+		artist_id = self.__artists.get_id(artist)
+		if artist_id is None:
+			return MusicCatalog()
+		
+		cmd = "SELECT %s FROM Music WHERE ArtistId = ?" % self.music_columns
+		rows = self.__db_helper.execute_reader(cmd, (artist_id,))
+		return self.create_musics(rows)
 
 	def find_all_by_album(self, album):
-		cmd = "SELECT Path FROM Music WHERE Album = '%s'" % album.replace("'", "''")
-		rows = self.__db_helper.execute_reader(cmd)
-		result = [Music(row[0]) for row in rows if self.exists(row[0])]
-		return result
-
-	def save(self, music):
-		cmd = "INSERT INTO Music (Path, Artist, Album) VALUES('%s', '%s', '%s')" % (
-			music.file_path.replace("'", "''"),	music.artist.replace("'", "''"), 
-			music.album.replace("'", "''"))
-		result = self.__db_helper.execute_nonquery(cmd)
+		album_id = self.__albums.get_id(album)
+		if album_id is None:
+			return MusicCatalog()
+		
+		cmd = "SELECT %s FROM Music WHERE AlbumId = ?" % self.music_columns
+		rows = self.__db_helper.execute_reader(cmd, (album_id,))
+		return self.create_musics(rows)
+
+	def text(self, value):
+		if value is None: # missing tags are stored as NULL
+			return None
+		return unicode(value)
+
+	def save(self, music, batch=None):
+		artist_id = self.__artists.save_name(music.artist, batch)
+		album_id = self.__albums.save_name(music.album, batch)
+		title_key = None
+		if music.title is not None:
+			title_key = MusicCatalog.title_key(self.text(music.title))
+		cmd = "INSERT INTO Music (%s, FileSize, FileModified, ArtistId, AlbumId, TitleKey) " % \
+			self.music_columns + "VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+		params = (self.text(music.file_path), self.text(music.title), 
+			self.text(music.artist), self.text(music.album), 
+			self.text(music.year), self.text(music.comment), 
+			music.number, music.length, music.file_size, music.file_mtime, 
+			artist_id, album_id, title_key)
+		if batch:
+			result = batch.execute(cmd, params)
+		else:
+			result = self.__db_helper.execute_nonquery(cmd, params)
 		assert result > 0
+		self.__search_index.save(music.file_path, (music.title, music.artist, music.album), batch)
+		self.invalidate_stats()
 
-	def delete(self, music_path):
-		cmd = "DELETE FROM Music WHERE Path = '%s'" % music_path.replace("'", "''")
+	def save_all(self, musics):
+		batch = BatchTransaction(self.__db_helper, None)
+		try:
+			for music in musics:
+				self.save(music, batch)
+			batch.commit()
+		except:
+			self.rollback(batch)
+			raise
+
+	def delete(self, music_path, batch=None):
+		cmd = "DELETE FROM Music WHERE Path = ?"
 		
-		result = self.__db_helper.execute_nonquery(cmd)
+		if batch:
+			result = batch.execute(cmd, (music_path,))
+		else:
+			result = self.__db_helper.execute_nonquery(cmd, (music_path,))
 		assert result > 0
+		self.__search_index.delete_all([music_path], batch)
+		self.invalidate_stats()
+
+	def delete_all(self, musics_path, batch=None):
+		self.__db_helper.delete_all("Music", "Path", musics_path, transaction=batch)
+		self.__search_index.delete_all(musics_path, batch)
+		self.invalidate_stats()
+
+	def search(self, text, max_results=100):
+		paths = self.__search_index.find_paths(text, max_results)
+		paths.sort()
+		return self.find_all_by_paths(paths)
+
+	def find_all_by_paths(self, paths, batch_size=50):
+		# DBMS SQL has no IN operator, so the paths are read in OR batches
+		catalog = MusicCatalog()
+		for start in range(0, len(paths), batch_size):
+			batch = paths[start:start + batch_size]
+			cmd = "SELECT %s FROM Music WHERE %s" % (self.music_columns, 
+													" OR ".join(["Path = ?"] * len(batch)))
+			self.create_musics(self.__db_helper.cursor(cmd, batch), catalog)
+		
+		return catalog
+
+	def find_all_musics_file_info(self):
+		cmd = "SELECT Path, FileSize, FileModified FROM Music"
+		result = {}
+		for row in self.__db_helper.cursor(cmd):
+			result[row[0]] = (row[1], row[2])
+		
+		return result
 
-	def rebuild_library(self, musics_path):
-		cmd = "DELETE FROM Music"
-		result = self.__db_helper.execute_nonquery(cmd)
+	def get_file_info(self, path):
+		file_info = os.stat(path.encode("utf8"))
+		return (file_info.st_size, int(file_info.st_mtime))
 
-		new_musics = []
-		for file in musics_path:
-			try:
-				music = Music(file)
-				new_musics.append(music)
-			except:
-				self.__logger.debug("Adding file to library error: '%s'" % \
-					''.join(traceback.format_exception(*sys.exc_info())))
+	def log_read_error(self, path, error):
+		self.__logger.debug("Adding file to library error: '%s'" % error)
 
-		for music in new_musics:
-			self.save(music) 
+	def save_all_from_files(self, musics_path, progress, replace=False, transaction=None):
+		batch = transaction or BatchTransaction(self.__db_helper, None)
+		def save(music):
+			if replace: # the old row is only deleted once the file was read again
+				self.delete(music.file_path, batch)
+			self.save(music, batch)
+			progress.step()
+		
+		def read_error(path, error):
+			self.log_read_error(path, error)
+			progress.step()
+		
+		if transaction: # committed or rolled back by the caller
+			return self.__tags_reader.read_all(musics_path, save, read_error)
+		
+		try:
+			count = self.__tags_reader.read_all(musics_path, save, read_error)
+			batch.commit()
+		except:
+			self.rollback(batch)
+			raise
+		
+		return count
 
-		return len(new_musics)
+	def rollback(self, batch):
+		batch.rollback()
+		# names saved in the batch are gone too, and the stats row may be back
+		self.__artists.reset()
+		self.__albums.reset()
+		self.__stats = None
+		self.__stats_saved = True
 
-	def update_library(self, musics_path):
-		all_music_in_db_path = self.find_all_musics_path()
-		
-		to_be_added = [x for x in musics_path if x not in all_music_in_db_path]
-		to_be_deleted = [x for x in all_music_in_db_path if x not in musics_path]
+	def rebuild_library(self, musics_path, progress_handler=None):
+		# a single transaction, so an interrupted rebuild keeps the old library
+		batch = BatchTransaction(self.__db_helper, None)
+		try:
+			batch.execute("DELETE FROM Music")
+			self.__search_index.clear(batch)
+			added = self.save_all_from_files(musics_path, ScanProgress(progress_handler), 
+											False, batch)
+			batch.commit()
+		except:
+			self.rollback(batch)
+			raise
 		
-		new_musics = []
-		for file in to_be_added:
+		self.invalidate_stats()
+		self.update_stats()
+		return added
+
+	def update_library(self, musics_path, progress_handler=None):
+		progress = ScanProgress(progress_handler)
+		musics_in_db = self.find_all_musics_file_info()
+		scanned = {}
+		to_be_added = []
+		to_be_updated = []
+		
+		for path in musics_path:
+			if scanned.has_key(path):
+				continue
+			scanned[path] = True
+			
+			if not musics_in_db.has_key(path):
+				to_be_added.append(path)
+				continue
+			
+			file_info = musics_in_db[path]
+			del musics_in_db[path]
 			try:
-				music = Music(file)
-				new_musics.append(music)
-			except:
-				self.__logger.debug("Adding file to library error: '%s'" % \
-					''.join(traceback.format_exception(*sys.exc_info())))
+				if self.get_file_info(path) != file_info:
+					to_be_updated.append(path)
+					continue
+			except OSError:
+				musics_in_db[path] = file_info
+			# the files read again are counted when they are saved
+			progress.step()
+		
+		to_be_deleted = musics_in_db.keys()
+		batch = BatchTransaction(self.__db_helper, None)
+		try:
+			self.delete_all(to_be_deleted, batch)
+			added = self.save_all_from_files(to_be_added, progress, False, batch)
+			updated = self.save_all_from_files(to_be_updated, progress, True, batch)
+			batch.commit()
+		except:
+			self.rollback(batch)
+			raise
+		
+		self.update_stats()
+
+		return (added, updated, len(to_be_deleted))
 
-		for music in new_musics:
-			self.save(music) 
+
+class NameRepository(object):
+	# DBMS SQL has no joins, so the names are kept in memory by id once loaded
+	def __init__(self, db_helper, table):
+		self.__db_helper = db_helper
+		self.__table = table
+		self.__ids = None
+		self.__names = None
+		self.__next_id = 1
+
+	def load(self):
+		if self.__ids is None:
+			self.__ids = {}
+			self.__names = {}
+			rows = self.__db_helper.execute_reader("SELECT Id, Name FROM %s" % self.__table)
+			for row in rows:
+				self.__ids[row[1]] = row[0]
+				self.__names[row[0]] = row[1]
+				self.__next_id = max(self.__next_id, row[0] + 1)
+
+	def get_id(self, name):
+		self.load()
+		return self.__ids.get(name or u"")
+
+	def get_name(self, name_id):
+		self.load()
+		return self.__names.get(name_id)
+
+	def find_all_names(self):
+		cmd = "SELECT Name FROM %s ORDER BY Name" % self.__table
+		return [row[0] for row in self.__db_helper.execute_reader(cmd)]
+
+	def save_name(self, name, batch=None):
+		name = name or u""
+		name_id = self.get_id(name)
+		if name_id is None:
+			name_id = self.__next_id
+			cmd = "INSERT INTO %s (Id, Name) VALUES(?, ?)" % self.__table
+			if batch:
+				batch.execute(cmd, (name_id, name))
+			else:
+				self.__db_helper.execute_nonquery(cmd, (name_id, name))
+			
+			self.__ids[name] = name_id
+			self.__names[name_id] = name
+			self.__next_id += 1
+		
+		return name_id
+
+	def delete_unused(self, used_ids):
+		self.load()
+		unused = [name_id for name_id in self.__names.keys() if not used_ids.has_key(name_id)]
+		self.__db_helper.delete_all(self.__table, "Id", unused)
+		for name_id in unused:
+			del self.__ids[self.__names[name_id]]
+			del self.__names[name_id]
+
+	def reset(self):
+		self.__ids = None
+		self.__names = None
+
+
+class SearchIndexRepository(object):
+	# words of the titles, artists and albums, found by prefix with range lookups 
+	# on the Token index instead of LIKE scans on the Music table
+	max_token_length = 50
+	word_pattern = re.compile(r"\w+", re.UNICODE)
+
+	def __init__(self, db_helper):
+		self.__db_helper = db_helper
+
+	def tokenize(text):
+		text = UnicodeHelper.safe_unicode(text or u"").lower()
+		return SearchIndexRepository.word_pattern.findall(text)
 	
-		for music_path in to_be_deleted:
-			self.delete(music_path)
+	tokenize = staticmethod(tokenize)
+
+	def save(self, path, texts, batch=None):
+		tokens = {}
+		for text in texts:
+			for token in self.tokenize(text):
+				tokens[token[:self.max_token_length]] = True
+		
+		cmd = "INSERT INTO Search_Token (Token, Path) VALUES(?, ?)"
+		for token in tokens.keys():
+			if batch:
+				batch.execute(cmd, (token, path))
+			else:
+				self.__db_helper.execute_nonquery(cmd, (token, path))
+
+	def delete_all(self, paths, batch=None):
+		self.__db_helper.delete_all("Search_Token", "Path", paths, transaction=batch)
+
+	def clear(self, batch=None):
+		if batch:
+			batch.execute("DELETE FROM Search_Token")
+		else:
+			self.__db_helper.execute_nonquery("DELETE FROM Search_Token")
+
+	def find_paths(self, text, max_results=100):
+		# musics with words starting with each word of text
+		prefixes = [(len(prefix), prefix) for prefix in self.tokenize(text)]
+		prefixes.sort()
+		prefixes.reverse() # the longest prefixes find less musics
+		
+		paths = None
+		cmd = "SELECT Path FROM Search_Token WHERE Token >= ? AND Token < ?"
+		for i in range(len(prefixes)):
+			prefix = prefixes[i][1][:self.max_token_length]
+			end = prefix[:-1] + unichr(ord(prefix[-1]) + 1)
+			is_last = i == len(prefixes) - 1
+			found = {}
+			for row in self.__db_helper.cursor(cmd, (prefix, end)):
+				if paths is None or paths.has_key(row[0]):
+					found[row[0]] = True
+					if is_last and len(found) >= max_results:
+						break
+			
+			paths = found
+			if not paths:
+				break
+		
+		if not paths:
+			return []
+		
+		return paths.keys()
+
+
+class ScanDirectoryRepository(object):
+	def __init__(self, db_helper):
+		self.__db_helper = db_helper
 
-		return (len(new_musics), len(to_be_deleted))
+	def load_cache(self, use_cached_directories=True):
+		directories = {}
+		rows = self.__db_helper.execute_reader("SELECT Path, Parent, Modified FROM Scan_Directory")
+		for row in rows:
+			directories[row[0]] = (row[1], row[2])
+		
+		musics_path = []
+		if use_cached_directories:
+			rows = self.__db_helper.cursor("SELECT Path FROM Music")
+			musics_path = [row[0] for row in rows]
+		
+		return DirectoryScanCache(directories, musics_path, use_cached_directories)
+
+	def save_cache(self, cache):
+		changed = cache.changed.keys()
+		to_be_deleted = [path for path in changed if cache.directories.has_key(path)]
+		to_be_deleted.extend(cache.get_vanished())
+		self.__db_helper.delete_all("Scan_Directory", "Path", to_be_deleted)
+		
+		for path in changed:
+			parent, modified = cache.changed[path]
+			cmd = "INSERT INTO Scan_Directory (Path, Parent, Modified) VALUES(?, ?, ?)"
+			self.__db_helper.execute_nonquery(cmd, (path, parent, modified))
 
 
 class AudioScrobblerUserRepository(object):
@@ -662,46 +1514,103 @@ class AudioScrobblerUserRepository(object):
 	
 	def save(self, user):
 		remove_cmd = "DELETE FROM User"
-		insert_cmd = "INSERT INTO User (UserName, Password) VALUES('%s', '%s')" % (
-					user.username.replace("'", "''"), user.password.replace("'", "''"))
+		insert_cmd = "INSERT INTO User (UserName, Password) VALUES(?, ?)"
 
 		result = self.__db_helper.execute_nonquery(remove_cmd)
-		result = self.__db_helper.execute_nonquery(insert_cmd)
+		result = self.__db_helper.execute_nonquery(insert_cmd, (user.username, user.password))
 		assert result > 0
 	
 
 class MusicHistoryRepository(object):
 	def __init__(self, db_helper):
 		self.__db_helper = db_helper
+		self.__next_id = None
 	
-	def save_music(self, music):
-		cmd = "INSERT INTO Music_History (Artist, Track, PlayedAt, Album, TrackLength) VALUES('%s', '%s', %i, '%s', %i)" % \
-				(music.artist.replace("'", "''"), music.title.replace("'", "''"), 
-					music.played_at, music.album.replace("'", "''"), music.length)
-		
-		result = self.__db_helper.execute_nonquery(cmd)
+	def get_next_id(self):
+		# DBMS SQL has no MAX(), the last id is the first one in descending order
+		if self.__next_id is None:
+			cmd = "SELECT Id FROM Music_History ORDER BY Id DESC"
+			row = self.__db_helper.cursor(cmd).fetch_one()
+			self.__next_id = (row and row[0] or 0) + 1
+		
+		return self.__next_id
+
+	def save_music(self, music, batch=None):
+		history_id = self.get_next_id()
+		cmd = "INSERT INTO Music_History (Id, Artist, Track, PlayedAt, Album, TrackLength) VALUES(?, ?, ?, ?, ?, ?)"
+		params = (history_id, music.artist, music.title, music.played_at, music.album, music.length)
+		
+		if batch:
+			result = batch.execute(cmd, params)
+		else:
+			result = self.__db_helper.execute_nonquery(cmd, params)
 		assert result > 0
+		self.__next_id = history_id + 1
+		music.history_id = history_id
+		return history_id
+
+	def get_last_journal_seq(self):
+		row = self.__db_helper.cursor("SELECT Seq FROM Journal_Applied").fetch_one()
+		return row and row[0] or 0
+
+	def save_new_musics(self, musics):
+		# the journaled plays after the last one applied are saved in the same 
+		# transaction as the new last one, so none is saved twice after a crash
+		last_seq = self.get_last_journal_seq()
+		new_musics = [music for music in musics if music.journal_seq > last_seq]
+		if not new_musics:
+			return 0
+		
+		batch = BatchTransaction(self.__db_helper, None)
+		try:
+			for music in new_musics:
+				self.save_music(music, batch)
+				last_seq = max(last_seq, music.journal_seq)
+			batch.execute("UPDATE Journal_Applied SET Seq = ?", (last_seq,))
+			batch.commit()
+		except:
+			batch.rollback()
+			self.__next_id = None
+			raise
+		
+		return len(new_musics)
 
 	def remove_musics(self, musics):
-		for music in musics:
-			cmd = "DELETE FROM Music_History WHERE PlayedAt = %i" % (music.played_at)
-			self.__db_helper.execute_nonquery(cmd)
+		ids = [music.history_id for music in musics]
+		if not ids:
+			return
+		
+		ids.sort()
+		if ids[-1] - ids[0] + 1 == len(ids): # usually a batch is a sequence of plays
+			cmd = "DELETE FROM Music_History WHERE Id >= ? AND Id <= ?"
+			self.__db_helper.execute_nonquery(cmd, (ids[0], ids[-1]))
+		else:
+			self.__db_helper.delete_all("Music_History", "Id", ids, len(ids))
 	
 	def clear_history(self):
 		cmd = "DELETE FROM Music_History"
 		self.__db_helper.execute_nonquery(cmd)
 	
 	def load_all_history(self):
-		cmd = "SELECT Artist, Track, PlayedAt, Album, TrackLength FROM Music_History"
-		rows = self.__db_helper.execute_reader(cmd)
+		cmd = "SELECT Id, Artist, Track, PlayedAt, Album, TrackLength FROM Music_History"
+		return self.load_history(cmd)
+	
+	def load_history_after(self, history_id):
+		cmd = "SELECT Id, Artist, Track, PlayedAt, Album, TrackLength FROM Music_History " + \
+			"WHERE Id > ? ORDER BY Id"
+		return self.load_history(cmd, (history_id,))
+	
+	def load_history(self, cmd, params=()):
+		rows = self.__db_helper.execute_reader(cmd, params)
 		result = []
 		for row in rows:
 			music = Music()
-			music.artist = row[0]
-			music.title = row[1]
-			music.played_at = row[2]
-			music.album = row[3]
-			music.length = row[4]
+			music.history_id = row[0]
+			music.artist = row[1]
+			music.title = row[2]
+			music.played_at = row[3]
+			music.album = row[4]
+			music.length = row[5]
 			result.append(music)
 	
 		return result
@@ -726,6 +1635,10 @@ class NoAudioScrobblerUserError(Exception):
 	pass
 
 
+class AudioScrobblerHandshakeError(Exception):
+	pass
+
+
 class HardErrorController(object):
 	def __init__(self, disconnect_handler):
 		self.__hard_error_counter = 0
@@ -787,17 +1700,62 @@ class AudioScrobblerService(object):
 		self.__post_url = None
 		self.__hard_error_controller = HardErrorController(self.force_disconnect)
 		self.__force_new_login = False
+		self.__user = None
+		self.__http = HttpConnectionPool()
+		# the session and the error controller are shared by the UI thread 
+		# and the scrobble worker
+		self.__session_lock = thread.allocate_lock()
 
 	def force_disconnect(self):
 		self.__force_new_login = True
 	
+	def locked(self, function, *args):
+		self.__session_lock.acquire()
+		try:
+			return function(*args)
+		finally:
+			self.__session_lock.release()
+	
 	def check_connection(self):
-		if self.__force_new_login:
-			self.login()
-			self.__force_new_login()
+		# the handshake runs out of the lock, so now playing on the UI thread 
+		# never waits for the network of the worker, only for the session swap
+		if self.locked(self.take_forced_login):
+			try:
+				self.login()
+			except:
+				self.locked(self.force_disconnect)
+				raise
+		
+		return self.locked(self.get_session)
+	
+	def take_forced_login(self):
+		forced = self.__force_new_login
+		self.__force_new_login = False
+		return forced
+	
+	def get_session(self):
+		return (self.__session_id, self.__now_url, self.__post_url)
+	
+	def set_session(self, session):
+		self.__session_id, self.__now_url, self.__post_url = session
+		self.__hard_error_controller.logging_sucessful()
+	
+	def handle_hard_error(self, during_handshake=False):
+		self.locked(self.__hard_error_controller.handle_hard_error, during_handshake)
+	
+	def force_new_handshake(self):
+		self.locked(self.__hard_error_controller.force_new_handshake)
 	
 	def set_credentials(self, user):
 		self.__user_repository.save(user)
+		self.__user = user
+	
+	def load_user(self):
+		# cached, a new login from the scrobble worker thread must not use the database
+		if not self.__user:
+			self.__user = self.__user_repository.load()
+		
+		return self.__user
 	
 	def user_changed(self, username):
 		user = self.__user_repository.load()
@@ -807,7 +1765,7 @@ class AudioScrobblerService(object):
 		return False
 		
 	def create_handshake_data(self):
-		user = self.__user_repository.load()
+		user = self.load_user()
 		if not user:
 			raise NoAudioScrobblerUserError("You must set an user/password first")
 		
@@ -829,27 +1787,25 @@ class AudioScrobblerService(object):
    		return urllib.urlencode(values)
 
 	def login(self):
-		self.__hard_error_controller.check_waiting()
+		self.locked(self.__hard_error_controller.check_waiting)
 		
 		try:
 			hand_shake_data = self.create_handshake_data()
-			response = urllib.urlopen("%s?%s" % (self.__handshake_url, hand_shake_data))
+			response = self.__http.request("%s?%s" % (self.__handshake_url, hand_shake_data))
 			as_response_data = self.handle_handshake_response(response)
-			self.__session_id, self.__now_url, self.__post_url = as_response_data
-			self.__hard_error_controller.logging_sucessful()
+			self.locked(self.set_session, as_response_data)
 			self.__logger.debug("Login was OK: ID %s, NowUrl %s, PostUrl %s" % (
 																as_response_data))
 		except NoAudioScrobblerUserError: raise
 		except AudioScrobblerError: raise
 		except AudioScrobblerCredentialsError: raise
 		except:
-			self.__hard_error_controller.handle_hard_error(True)
+			self.handle_hard_error(True)
 			self.__logger.debug("Login error: '%s'" % \
 							''.join(traceback.format_exception(*sys.exc_info())))
 			raise
 		
-	def handle_handshake_response(self, response):
-		result = response.read()
+	def handle_handshake_response(self, result):
 		lines = result.split("\n")
 
 		if lines[0] == "OK":
@@ -865,16 +1821,16 @@ class AudioScrobblerService(object):
 		elif error == "BADTIME":
 			raise AudioScrobblerError("Your system time is out of sync with Audioscrobbler. Update it!.")
 		elif error.startswith("FAILED"):
-	  		raise Exception("Authentication with AS failed. Reason: %s" % error)
+	  		raise AudioScrobblerHandshakeError("Authentication with AS failed. Reason: %s" % error)
 		else:
-			raise Exception("Authentication with AS failed.")
+			raise AudioScrobblerHandshakeError("Authentication with AS failed.")
 	
 	def now_playing(self, music):
 		if not music.can_send_now_playing(): return True
-		self.check_connection()
+		session_id, now_url, post_url = self.check_connection()
 		
 		values = {
-			"s": self.__session_id, 
+			"s": session_id, 
 			"a": unicode(music.artist).encode("utf-8"), 
 			"t": unicode(music.title).encode("utf-8"), 
 			"b": unicode(music.album).encode("utf-8"), 
@@ -885,28 +1841,26 @@ class AudioScrobblerService(object):
 
 		try:
 			data = urllib.urlencode(values)
-			response = urllib.urlopen(self.__now_url, data)
-			result = response.read()
+			result = self.__http.request(now_url, data)
 
 			if result.strip() == "OK":
 				music.now_playing_sent = True
 				self.__logger.debug("Now playing sent for %s" % music.title)
 				return True
 			elif result.strip() == "BADSESSION":
-				self.__hard_error_controller.force_new_handshake()
+				self.force_new_handshake()
 		except:
-			self.__hard_error_controller.handle_hard_error()
+			self.handle_hard_error()
 			self.__logger.debug("Now playing error: '%s'" % \
 							''.join(traceback.format_exception(*sys.exc_info())))
 		
 		return False
 	
 	def send(self, musics):
-		self.check_connection()
+		session_id, now_url, post_url = self.check_connection()
 		try:
-			data = self.create_send_music_data(musics)
-			response = urllib.urlopen(self.__post_url, data)
-			result = response.read()
+			data = self.create_send_music_data(musics, session_id)
+			result = self.__http.request(post_url, data)
 			result_value = result.split("\n")[0]
 			
 			if result_value == "OK":
@@ -915,17 +1869,20 @@ class AudioScrobblerService(object):
 				
 				return True
 			elif result_value.startswith("BADSESSION"):
-				self.__hard_error_controller.force_new_handshake()
+				self.force_new_handshake()
 			elif result_value.startswith("FAILED"):
 				raise AudioScrobblerError("Submission to AS failed. Reason: %s" % result_value)
 		except:
-			self.__hard_error_controller.handle_hard_error()
+			self.handle_hard_error()
 			self.__logger.debug("Scrobbling error: '%s'" % \
 							 ''.join(traceback.format_exception(*sys.exc_info())))
 
 		return False
 
-	def create_send_music_data(self, musics):
+	def close_connections(self):
+		self.__http.close()
+
+	def create_send_music_data(self, musics, session_id):
 		musics_data = []
 		
 		for music in musics:
@@ -948,12 +1905,251 @@ class AudioScrobblerService(object):
 				values[key + ("[%d]" % i)] = item[key]
 			i = i + 1
 			
-		values["s"] = self.__session_id
+		values["s"] = session_id
 		data = urllib.urlencode(values)
 		
 		return data
 
 
+class MusicTagsReader(object):
+	def __init__(self, workers=2, queue_size=20):
+		self.__workers = workers
+		self.__queue_size = queue_size
+		self.__stopped = False
+
+	def read(self, path):
+		try:
+			return (Music(path), None)
+		except:
+			return (None, ''.join(traceback.format_exception(*sys.exc_info())))
+
+	def read_all(self, musics_path, music_handler, error_handler):
+		# the handlers are always called from the calling thread, 
+		# so they can safely use the database
+		if self.__workers < 2:
+			return self.read_all_sequentially(musics_path, music_handler, error_handler)
+		
+		self.__stopped = False
+		self.__paths_error = None
+		paths = iter(musics_path)
+		paths_lock = thread.allocate_lock()
+		results = BlockingQueue(self.__queue_size)
+		
+		for i in range(self.__workers):
+			thread.start_new_thread(self.worker, (paths, paths_lock, results))
+		
+		read_count = 0
+		finished_workers = 0
+		while finished_workers < self.__workers:
+			result = results.get()
+			if result is None:
+				finished_workers += 1
+				continue
+			
+			path, music, error = result
+			try:
+				if music:
+					music_handler(music)
+					read_count += 1
+				else:
+					error_handler(path, error)
+			except:
+				self.__stopped = True
+				self.wait_workers(results, self.__workers - finished_workers)
+				raise
+		
+		if self.__paths_error:
+			# the scan was interrupted, e.g. by a file system error
+			error_type, error_value, error_tb = self.__paths_error
+			self.__paths_error = None
+			raise error_type, error_value, error_tb
+		
+		return read_count
+
+	def read_all_sequentially(self, musics_path, music_handler, error_handler):
+		read_count = 0
+		for path in musics_path:
+			music, error = self.read(path)
+			if music:
+				music_handler(music)
+				read_count += 1
+			else:
+				error_handler(path, error)
+		
+		return read_count
+
+	def worker(self, paths, paths_lock, results):
+		while not self.__stopped:
+			paths_lock.acquire()
+			try:
+				try:
+					path = paths.next()
+				except StopIteration:
+					path = None
+				except:
+					self.__paths_error = sys.exc_info()
+					self.__stopped = True
+					path = None
+			finally:
+				paths_lock.release()
+			
+			if path is None:
+				break
+			
+			music, error = self.read(path)
+			results.put((path, music, error))
+		
+		results.put(None)
+
+	def wait_workers(self, results, running_workers):
+		while running_workers > 0:
+			if results.get() is None:
+				running_workers -= 1
+
+
+class ScrobbleSubmitter(object):
+	# sends the history from a worker thread, which keeps the plays not sent 
+	# until the next submit. Only the thread that started it uses the database: 
+	# each batch sent, or the error that stopped it, is reported through a callgate.
+	batch_size = 50
+	queue_size = 100
+
+	def __init__(self, music_history, audio_scrobbler_service, status_handler=None):
+		self.__music_history = music_history
+		self.__audio_scrobbler_service = audio_scrobbler_service
+		self.status_handler = status_handler
+		self.__commands = None
+		self.__report = None
+		self.__last_queued_id = 0
+		self.sent = 0
+		self.failures = 0
+
+	def start(self):
+		if not self.__commands:
+			self.__commands = BlockingQueue(self.queue_size)
+			self.__report = e32.ao_callgate(self.batch_finished)
+			thread.start_new_thread(self.worker, (self.__commands,))
+
+	def submit(self):
+		self.start()
+		musics = self.__music_history.load_history_after(self.__last_queued_id)
+		if musics:
+			self.__last_queued_id = musics[-1].history_id
+		self.__commands.put(("send", musics))
+
+	def clear(self):
+		if self.__commands:
+			self.__commands.put(("clear", None))
+
+	def stop(self):
+		if self.__commands:
+			self.__commands.put(("stop", None))
+			self.__commands = None
+
+	def worker(self, commands):
+		pending = []
+		action = None
+		while action != "stop":
+			action, musics = commands.get()
+			if action == "clear":
+				pending = []
+			elif action == "send":
+				pending.extend(musics)
+				pending = self.send_batches(pending)
+
+	def send_batches(self, pending):
+		while pending:
+			batch = pending[:self.batch_size]
+			error = None
+			try:
+				sent = self.__audio_scrobbler_service.send(batch)
+			except (IOError, socket.error, AudioScrobblerWaitError, AudioScrobblerError, 
+					AudioScrobblerHandshakeError, AudioScrobblerCredentialsError, 
+					NoAudioScrobblerUserError), error:
+				sent = False
+			
+			if not sent:
+				self.__report(None, error)
+				break
+			
+			pending = pending[len(batch):]
+			self.__report(batch, None)
+		
+		return pending
+
+	def batch_finished(self, batch, error):
+		if batch:
+			self.__music_history.remove_sent(batch)
+			self.sent += len(batch)
+			self.failures = 0
+		else:
+			self.failures += 1
+		
+		if self.status_handler:
+			self.status_handler(self.sent, self.failures, error)
+
+
+class NowPlayingDispatcher(object):
+	# sends now playing once per music, after settle_seconds of playback so that 
+	# quick skips are coalesced. Failures are retried with an exponential backoff 
+	# and dropped after max_attempts.
+	settle_seconds = 5
+	first_retry_delay = 10
+	max_retry_delay = 120
+	max_attempts = 4
+
+	def __init__(self, audio_scrobbler_service, clock=None):
+		self.__audio_scrobbler_service = audio_scrobbler_service
+		self.__clock = clock or time.time
+		self.__music = None
+		self.__done = False
+		self.__failures = 0
+		self.__next_attempt = 0
+		self.sent = 0
+		self.dropped = 0
+		self.coalesced = 0
+
+	def update(self, music):
+		if music is not self.__music:
+			self.replace(music)
+		
+		if self.__done or music.position <= self.settle_seconds:
+			return
+		
+		now = self.__clock()
+		if now < self.__next_attempt:
+			return
+		
+		try:
+			sent = self.__audio_scrobbler_service.now_playing(music)
+		except:
+			sent = False
+		
+		if sent:
+			self.sent += 1
+			self.__done = True
+		else:
+			self.__failures += 1
+			if self.__failures >= self.max_attempts:
+				self.dropped += 1
+				self.__done = True
+			else:
+				delay = self.first_retry_delay * 2 ** (self.__failures - 1)
+				self.__next_attempt = now + min(delay, self.max_retry_delay)
+
+	def replace(self, music):
+		if self.__music and not self.__done:
+			if self.__failures:
+				self.dropped += 1
+			else:
+				self.coalesced += 1
+		
+		self.__music = music
+		self.__done = False
+		self.__failures = 0
+		self.__next_attempt = 0
+
+
 ##########################################################
 ######################### INFRASTRUCTURE 
 
@@ -975,11 +2171,511 @@ class UnicodeHelper(object):
 	safe_unicode = staticmethod(safe_unicode)
 
 
+class HttpConnectionPool(object):
+	# one idle HTTP/1.1 connection per host, checked out while a request uses it. 
+	# Network errors are raised as IOError as by urllib.urlopen, and so are the 
+	# HTTP error statuses, which urlopen returned as a response.
+	idle_timeout = 30
+
+	def __init__(self, idle_timeout=None):
+		if idle_timeout is not None:
+			self.idle_timeout = idle_timeout
+		self.__idle = {} # host: (connection, last used time)
+		self.__lock = thread.allocate_lock()
+		self.__last_error = None
+		self.connections_opened = 0
+		self.requests = 0
+
+	def request(self, url, data=None):
+		scheme, host, path, params, query, fragment = urlparse.urlparse(url)
+		path = path or "/"
+		if query:
+			path = "%s?%s" % (path, query)
+		
+		connection, reused = self.get_connection(host)
+		response, can_retry = self.try_send(connection, path, data)
+		if not response and reused and can_retry: # the server may have closed the idle connection
+			connection = self.open(host)
+			response, can_retry = self.try_send(connection, path, data)
+		if not response:
+			raise IOError("HTTP request to %s failed: %s" % (host, self.__last_error))
+		
+		status, body, keep_alive = response
+		if keep_alive:
+			self.release(host, connection)
+		else:
+			connection.close()
+		
+		if status < 200 or status >= 300:
+			raise IOError("HTTP error %i from %s" % (status, host))
+		return body
+
+	def try_send(self, connection, path, data):
+		# a POST is only sent again if it could not be written whole, as the 
+		# server may have received it, e.g. a scrobble submitted twice
+		try:
+			self.send(connection, path, data)
+		except (socket.error, httplib.HTTPException, IOError):
+			self.__last_error = sys.exc_info()[1]
+			connection.close()
+			return (None, True)
+		
+		try:
+			return (self.read_response(connection), False)
+		except (socket.error, httplib.HTTPException, IOError):
+			self.__last_error = sys.exc_info()[1]
+			connection.close()
+			return (None, data is None)
+
+	def send(self, connection, path, data):
+		if data is None:
+			connection.request("GET", path)
+		else:
+			headers = {"Content-Type": "application/x-www-form-urlencoded"}
+			connection.request("POST", path, data, headers)
+
+	def read_response(self, connection):
+		response = connection.getresponse()
+		body = response.read()
+		self.requests += 1
+		return (response.status, body, not response.will_close)
+
+	def get_connection(self, host):
+		self.__lock.acquire()
+		try:
+			entry = self.__idle.get(host)
+			if entry:
+				del self.__idle[host]
+		finally:
+			self.__lock.release()
+		
+		if entry:
+			connection, last_used = entry
+			if time.time() - last_used < self.idle_timeout:
+				return (connection, True)
+			connection.close()
+		
+		return (self.open(host), False)
+
+	def open(self, host):
+		self.connections_opened += 1
+		return httplib.HTTPConnection(host)
+
+	def release(self, host, connection):
+		self.__lock.acquire()
+		try:
+			previous = self.__idle.get(host)
+			self.__idle[host] = (connection, time.time())
+		finally:
+			self.__lock.release()
+		
+		if previous:
+			previous[0].close()
+
+	def close(self):
+		self.__lock.acquire()
+		try:
+			entries = self.__idle.values()
+			self.__idle = {}
+		finally:
+			self.__lock.release()
+		
+		for connection, last_used in entries:
+			connection.close()
+
+
+class BlockingQueue(object):
+	def __init__(self, max_size):
+		self.__items = []
+		self.__max_size = max_size
+		self.__mutex = thread.allocate_lock()
+		self.__not_empty = thread.allocate_lock()
+		self.__not_full = thread.allocate_lock()
+		self.__not_empty.acquire()
+
+	def put(self, item):
+		self.__not_full.acquire()
+		self.__mutex.acquire()
+		was_empty = not self.__items
+		self.__items.append(item)
+		if was_empty:
+			self.__not_empty.release()
+		if len(self.__items) < self.__max_size:
+			self.__not_full.release()
+		self.__mutex.release()
+
+	def get(self):
+		self.__not_empty.acquire()
+		self.__mutex.acquire()
+		was_full = len(self.__items) == self.__max_size
+		item = self.__items.pop(0)
+		if was_full:
+			self.__not_full.release()
+		if self.__items:
+			self.__not_empty.release()
+		self.__mutex.release()
+		return item
+
+
+class ScanProgress(object):
+	def __init__(self, handler=None, step_size=50):
+		self.__handler = handler
+		self.__step_size = step_size
+		self.count = 0
+
+	def step(self):
+		self.count += 1
+		if self.__handler and self.count % self.__step_size == 0:
+			self.__handler(self.count)
+
+
+class ScrobbleJournal(object):
+	# append-only file of the plays not saved in the database yet, one line per 
+	# play ending with its crc32 so that a line torn by a power loss is ignored. 
+	# Each play has a sequence number, set by the history from the last one saved, 
+	# and is synced as soon as it is written: a play lasts minutes, a sync does not.
+
+	def __init__(self, path):
+		self.path = path
+		self.next_seq = None
+		self.pending = 0
+		self.syncs = 0
+		self.__file = None
+		self.__unsynced = 0
+
+	def append(self, music):
+		music.journal_seq = self.next_seq
+		self.next_seq += 1
+		fields = [str(music.journal_seq), str(music.played_at), str(music.length or 0)]
+		for text in [music.artist, music.title, music.album]:
+			fields.append(self.encode(text))
+		record = "\t".join(fields)
+		
+		f = self.get_file()
+		f.write("%s\t%s\n" % (record, self.checksum(record)))
+		self.pending += 1
+		self.__unsynced += 1
+		self.sync()
+
+	def sync(self):
+		if self.__file and self.__unsynced:
+			self.__file.flush()
+			if hasattr(os, "fsync"):
+				os.fsync(self.__file.fileno())
+			else:
+				# PyS60 has no fsync, the file server only writes the file 
+				# out for sure when it is closed
+				self.__file.close()
+				self.__file = open(self.path, "ab")
+			self.__unsynced = 0
+			self.syncs += 1
+
+	def get_file(self):
+		if not self.__file:
+			torn = False
+			if os.path.exists(self.path):
+				f = open(self.path, "rb")
+				f.seek(0, 2)
+				if f.tell() > 0:
+					f.seek(-1, 2)
+					torn = f.read(1) != "\n"
+				f.close()
+			else:
+				dir = os.path.split(self.path)[0]
+				if dir and not os.path.exists(dir):
+					os.makedirs(dir)
+			
+			self.__file = open(self.path, "ab")
+			if torn: # the next play must not be glued to a torn line
+				self.__file.write("\n")
+		
+		return self.__file
+
+	def read_all(self):
+		self.sync()
+		if not os.path.exists(self.path):
+			return []
+		
+		f = open(self.path, "rb")
+		lines = f.read().split("\n")
+		f.close()
+		
+		musics = []
+		for line in lines:
+			music = self.decode(line)
+			if music:
+				musics.append(music)
+				if self.next_seq is not None:
+					self.next_seq = max(self.next_seq, music.journal_seq + 1)
+		
+		return musics
+
+	def truncate(self):
+		self.close()
+		if os.path.exists(self.path):
+			os.remove(self.path)
+		self.pending = 0
+
+	def close(self):
+		if self.__file:
+			self.sync()
+			self.__file.close()
+			self.__file = None
+
+	def decode(self, line):
+		fields = line.split("\t")
+		if len(fields) != 7:
+			return None
+		if self.checksum("\t".join(fields[:6])) != fields[6]:
+			return None
+		
+		music = Music()
+		try:
+			music.journal_seq = int(fields[0])
+			music.played_at = int(fields[1])
+			music.length = int(fields[2])
+		except ValueError:
+			return None
+		music.artist, music.title, music.album = [text and text.decode("utf8") or None for text in fields[3:6]]
+		return music
+
+	def encode(text):
+		if text is None:
+			return ""
+		
+		text = UnicodeHelper.safe_unicode(text)
+		for separator in [u"\t", u"\r", u"\n"]:
+			text = text.replace(separator, u" ")
+		return text.encode("utf8")
+
+	def checksum(record):
+		return "%08x" % (binascii.crc32(record) & 0xffffffffL)
+
+	encode = staticmethod(encode)
+	checksum = staticmethod(checksum)
+
+
+class BatchTransaction(object):
+	# commits every batch_size commands, or only on commit() when it is None
+	def __init__(self, db_helper, batch_size=100):
+		self.__db_helper = db_helper
+		self.__batch_size = batch_size
+		self.__pending = 0
+		self.__in_transaction = False
+
+	def execute(self, sql, params=()):
+		if not self.__in_transaction:
+			self.__db_helper.begin()
+			self.__in_transaction = True
+		
+		result = self.__db_helper.execute_nonquery(sql, params)
+		self.__pending += 1
+		if self.__batch_size and self.__pending >= self.__batch_size:
+			self.commit()
+		
+		return result
+
+	def commit(self):
+		if self.__in_transaction:
+			self.__db_helper.commit()
+			self.__in_transaction = False
+			self.__pending = 0
+
+	def rollback(self):
+		if self.__in_transaction:
+			self.__db_helper.rollback()
+			self.__in_transaction = False
+			self.__pending = 0
+
+
+class DbCursor(object):
+	# reads the rows of a view one at a time, the column types are checked on the first one
+	unreadable_types = (16,) # EDbColLongBinary
+
+	def __init__(self, view):
+		self.__view = view
+		self.__remaining = None # counted on the first fetch, not when the cursor is created
+		self.__at_row = getattr(view, "at_row", None)
+		self.__columns = None
+		view.first_line()
+
+	def get_readable_columns(self):
+		columns = []
+		for column in range(1, self.__view.col_count() + 1):
+			if self.__view.col_type(column) in self.unreadable_types:
+				columns.append(None)
+			else:
+				columns.append(column)
+		
+		return columns
+
+	def has_line(self):
+		if self.__at_row: # the sqlite3 views tell it without counting the lines
+			return self.__at_row()
+		
+		if self.__remaining is None:
+			self.__remaining = self.__view.count_line()
+		return self.__remaining > 0
+
+	def fetch_one(self):
+		if not self.has_line():
+			return None
+		
+		view = self.__view
+		view.get_line()
+		if self.__columns is None:
+			self.__columns = self.get_readable_columns()
+		
+		# columns are numbered from 1, so the unreadable ones (None) give None
+		row = [column and view.col(column) for column in self.__columns]
+		view.next_line()
+		if self.__remaining is not None:
+			self.__remaining -= 1
+		return row
+
+	def fetch_many(self, size):
+		rows = []
+		while len(rows) < size:
+			row = self.fetch_one()
+			if row is None:
+				break
+			rows.append(row)
+		
+		return rows
+
+	def fetch_all(self):
+		return [row for row in self]
+
+	def __iter__(self):
+		row = self.fetch_one()
+		while row is not None:
+			yield row
+			row = self.fetch_one()
+
+
+class DirectoryListingCache(object):
+	# a directory is listed again only when its modified time changes, and checked 
+	# at most once between two calls to start(). Names ignore the case, as on Symbian.
+	def __init__(self):
+		self.__listings = {} # lower case directory: (modified time, lower case names)
+		self.__checked = {}
+
+	def start(self):
+		self.__checked = {}
+
+	def exists(self, path):
+		names, name = self.lookup(path)
+		return names is not None and names.has_key(name)
+
+	def is_listed(self, path):
+		return self.lookup(path)[0] is not None
+
+	def lookup(self, path):
+		dirname, name = os.path.split(UnicodeHelper.safe_unicode(path))
+		key = dirname.lower()
+		if not self.__checked.has_key(key):
+			self.__checked[key] = True
+			self.refresh(key, dirname)
+		
+		return (self.__listings[key][1], name.lower())
+
+	def refresh(self, key, dirname):
+		try:
+			modified = os.stat(dirname.encode("utf8")).st_mtime
+			if self.__listings.has_key(key) and self.__listings[key][0] == modified:
+				return
+			
+			names = {}
+			for name in os.listdir(dirname.encode("utf8")):
+				names[UnicodeHelper.safe_unicode(name).lower()] = True
+		except OSError: # not listed, e.g. a removed memory card
+			self.__listings[key] = (None, None)
+			return
+		
+		self.__listings[key] = (modified, names)
+
+
+class LruCache(object):
+	def __init__(self, max_size=10):
+		self.__max_size = max_size
+		self.__items = {}
+		self.__keys = [] # least recently used first
+		self.hits = 0
+		self.misses = 0
+
+	def get(self, key):
+		if not self.__items.has_key(key):
+			self.misses += 1
+			return None
+		
+		self.hits += 1
+		self.__keys.remove(key)
+		self.__keys.append(key)
+		return self.__items[key]
+
+	def put(self, key, value):
+		if not self.__max_size:
+			return
+		
+		if self.__items.has_key(key):
+			self.__keys.remove(key)
+		elif len(self.__keys) >= self.__max_size:
+			del self.__items[self.__keys.pop(0)]
+		
+		self.__items[key] = value
+		self.__keys.append(key)
+
+	def clear(self):
+		if self.__keys:
+			self.__items = {}
+			self.__keys = []
+
+	def __len__(self):
+		return len(self.__keys)
+
+
+class DirectoryScanCache(object):
+	def __init__(self, directories=None, musics_path=None, use_cached_directories=True):
+		self.directories = directories or {}
+		self.use_cached_directories = use_cached_directories
+		self.visited = {}
+		self.changed = {}
+		
+		self.__sub_dirs = {}
+		for path, (parent, modified) in self.directories.items():
+			self.__sub_dirs.setdefault(parent, []).append(path)
+		
+		self.__files = {}
+		for path in musics_path or []:
+			self.__files.setdefault(os.path.dirname(path), []).append(path)
+
+	def get(self, dirname, modified):
+		# returns the known (files, sub directories) of a directory not changed since the last scan
+		entry = self.directories.get(dirname)
+		if not self.use_cached_directories or modified < 0 or not entry or entry[1] != modified:
+			return None
+		
+		return (self.__files.get(dirname, []), self.__sub_dirs.get(dirname, []))
+
+	def visit(self, dirname, parent, modified):
+		self.visited[dirname] = True
+		if self.directories.get(dirname) != (parent, modified):
+			self.changed[dirname] = (parent, modified)
+
+	def get_vanished(self):
+		return [path for path in self.directories.keys() if not self.visited.has_key(path)]
+
+
 class LogFactory(object):
+	loggers = {}
+
 	def create_for(name):
-		file_path = "%sdata\\aspyplayer\\log.txt" % FileSystemServices().get_data_drive()
-		logger = Logger(str(name), file_path)
-		return logger
+		name = str(name)
+		if not LogFactory.loggers.has_key(name):
+			file_path = "%sdata\\aspyplayer\\log.txt" % FileSystemServices().get_data_drive()
+			LogFactory.loggers[name] = Logger(name, file_path)
+		
+		return LogFactory.loggers[name]
 	
 	create_for = staticmethod(create_for)
 
@@ -1014,16 +2710,29 @@ class Logger(object):
 			
 
 class ServiceLocator(object):
+	tags_reader_workers = 2
+	scan_roots = ["C:\\", "E:\\"]
+	scan_excluded_dirs = ["?:\\sys", "?:\\system", "?:\\private", "?:\\resource", 
+						"?:\\data\\aspyplayer", "*\\cache", "*\\temp"]
+
 	def __init__(self):
-		self.file_system_services = FileSystemServices()
+		self.file_system_services = FileSystemServices(self.scan_roots, self.scan_excluded_dirs)
 		self.db_helper = DbHelper(self.file_system_services.get_db_file_path(), self.file_system_services)
 		self.history_repository = MusicHistoryRepository(self.db_helper)
 		self.user_repository = AudioScrobblerUserRepository(self.db_helper)
 		self.as_service = AudioScrobblerService(self.user_repository)	
-		self.music_history = MusicHistory(self.history_repository, self.as_service)
-		self.music_repository = MusicRepository(self.db_helper)
+		self.scrobble_journal = ScrobbleJournal(self.file_system_services.get_journal_file_path())
+		self.music_history = MusicHistory(self.history_repository, self.scrobble_journal)
+		self.music_history.compact_journal()
+		self.scrobble_submitter = ScrobbleSubmitter(self.music_history, self.as_service)
+		self.music_tags_reader = MusicTagsReader(self.tags_reader_workers)
+		self.music_repository = MusicRepository(self.db_helper, self.music_tags_reader)
+		self.scan_directory_repository = ScanDirectoryRepository(self.db_helper)
 
 	def close(self):
+		self.scrobble_submitter.stop()
+		self.as_service.close_connections()
+		self.music_history.close()
 		self.file_system_services = None
 		self.db_helper.close()
 		self.db_helper = None
@@ -1031,24 +2740,65 @@ class ServiceLocator(object):
 		self.user_repository = None
 		self.as_service = None	
 		self.music_history = None
+		self.scrobble_journal = None
+		self.scrobble_submitter = None
 		self.music_factory = None
 
 
 class FileSystemServices:
+	def __init__(self, scan_roots=None, excluded_dirs=None):
+		self.scan_roots = scan_roots or ["C:\\", "E:\\"]
+		self.excluded_dirs = excluded_dirs or []
+
 	def find_all_files(self, root_dir, file_extension):
-		result = []
-		predicate = lambda f: f.endswith(file_extension)
+		return list(self.iter_all_files(root_dir, file_extension))
+
+	def iter_all_files(self, root_dir, file_extension, directory_cache=None):
+		if not directory_cache:
+			directory_cache = DirectoryScanCache()
 		
-		def walk(arg, dirname, names):
-			files_filtered = filter(predicate, map(UnicodeHelper.safe_unicode, names))
+		pending_dirs = [(UnicodeHelper.safe_unicode(root_dir), u"")]
+		while pending_dirs:
+			dirname, parent = pending_dirs.pop()
+			modified = self.get_modified_time(dirname)
+			cached = directory_cache.get(dirname, modified)
 			
-			for file in files_filtered:
-				full_file_path = "%s\\%s" %(UnicodeHelper.safe_unicode(dirname), file)
-				result.append(full_file_path)
-		
-		os.path.walk(root_dir, walk, None)
+			if cached:
+				files, sub_dirs = cached
+				for full_path in files:
+					yield full_path
+			else:
+				try:
+					names = os.listdir(dirname.encode("utf8"))
+				except OSError:
+					continue
+				
+				sub_dirs = []
+				for name in names:
+					full_path = os.path.join(dirname, UnicodeHelper.safe_unicode(name))
+					if name.endswith(file_extension):
+						yield full_path
+					elif os.path.isdir(full_path.encode("utf8")):
+						sub_dirs.append(full_path)
+			
+			directory_cache.visit(dirname, parent, modified)
+			sub_dirs = [path for path in sub_dirs if not self.is_excluded(path)]
+			sub_dirs.reverse()
+			pending_dirs.extend([(path, dirname) for path in sub_dirs])
+
+	def get_modified_time(self, path):
+		try:
+			return int(os.stat(path.encode("utf8")).st_mtime)
+		except OSError:
+			return -1
+
+	def is_excluded(self, path):
+		path = path.lower()
+		for pattern in self.excluded_dirs:
+			if fnmatch.fnmatchcase(path, pattern.lower()):
+				return True
 		
-		return result
+		return False
 
 	def exists(self, path):
 		return os.path.exists(path)
@@ -1058,17 +2808,19 @@ class FileSystemServices:
 		if not os.path.exists(dir):
 			os.makedirs(dir)
 
-	def get_all_music_files_path_in_device(self):
-		all_musics_in_c = self.find_all_files("C:\\", ".mp3")
-		all_musics_in_e = self.find_all_files("E:\\", ".mp3")
-		all_music = []
-		all_music.extend(all_musics_in_c)
-		all_music.extend(all_musics_in_e)
-		return all_music
+	def get_all_music_files_path_in_device(self, directory_cache=None):
+		for root_dir in self.scan_roots:
+			if self.is_excluded(root_dir):
+				continue
+			for path in self.iter_all_files(root_dir, ".mp3", directory_cache):
+				yield path
 
 	def get_db_file_path(self):
 		return "%sdata\\aspyplayer\\aspyplayer.db" % self.get_data_drive()
 
+	def get_journal_file_path(self):
+		return "%sdata\\aspyplayer\\scrobbles.log" % self.get_data_drive()
+
 	def get_data_drive(self):
 		if not self.exists("E:\\"):
 			return "C:\\"
@@ -1076,14 +2828,170 @@ class FileSystemServices:
 		return "E:\\"
 
 
+class E32DbBackend(object):
+	# storage of the phone, on the Symbian DBMS
+	KErrAlreadyExists = -11
+	error_code_pattern = re.compile(r"\[Errno (-?\d+)\]")
+
+	def __init__(self):
+		self.db = e32db.Dbms()
+
+	def create(self, path):
+		self.db.create(path)
+
+	def open(self, path):
+		self.db.open(path)
+
+	def close(self):
+		self.db.close()
+
+	def execute(self, sql):
+		return self.db.execute(sql)
+
+	def prepare(self, sql):
+		view = e32db.Db_view()
+		view.prepare(self.db, sql)
+		return view
+
+	def already_exists(error):
+		# the DBMS errors read "[Errno -11] KErrAlreadyExists", other codes 
+		# may hold the same digits, e.g. -110
+		code = None
+		if error.args and isinstance(error.args[0], int):
+			code = error.args[0]
+		else:
+			match = E32DbBackend.error_code_pattern.search(str(error))
+			if match:
+				code = int(match.group(1))
+		
+		return code == E32DbBackend.KErrAlreadyExists
+	already_exists = staticmethod(already_exists)
+
+	def begin(self):
+		self.db.begin()
+
+	def commit(self):
+		self.db.commit()
+
+	def rollback(self):
+		self.db.rollback()
+
+
+class Sqlite3Backend(object):
+	# storage to run the repositories off the phone, e.g. to profile the queries
+	def __init__(self):
+		self.connection = None
+
+	def create(self, path):
+		sqlite3.connect(path.encode("utf8")).close()
+
+	def open(self, path):
+		# the transactions are explicit, as in the DBMS
+		self.connection = sqlite3.connect(path.encode("utf8"), isolation_level=None)
+
+	def close(self):
+		self.connection.close()
+
+	def execute(self, sql):
+		return max(self.connection.execute(sql).rowcount, 0)
+
+	def prepare(self, sql):
+		return Sqlite3View(self.connection, sql)
+
+	def already_exists(self, error):
+		return str(error).find("already exists") != -1
+
+	def begin(self):
+		self.connection.execute("BEGIN")
+
+	def commit(self):
+		self.connection.execute("COMMIT")
+
+	def rollback(self):
+		self.connection.execute("ROLLBACK")
+
+
+class Sqlite3View(object):
+	# the rows of a sqlite3 query, read one at a time as from an e32db.Db_view
+	table_pattern = re.compile(r"\bFROM\s+(\w+)", re.IGNORECASE)
+
+	def __init__(self, connection, sql):
+		self.__connection = connection
+		self.__sql = sql
+		self.__cursor = connection.execute(sql)
+		self.__row = self.__cursor.fetchone()
+		self.__moved = False
+		self.__count = None
+		self.__types = None
+
+	def first_line(self):
+		if self.__moved: # the query is run again to go back to the first row
+			self.__cursor = self.__connection.execute(self.__sql)
+			self.__row = self.__cursor.fetchone()
+			self.__moved = False
+
+	def get_line(self):
+		pass
+
+	def next_line(self):
+		self.__row = self.__cursor.fetchone()
+		self.__moved = True
+
+	def at_row(self):
+		return self.__row is not None
+
+	def count_line(self):
+		if self.__count is None:
+			cmd = "SELECT COUNT(*) FROM (%s)" % self.__sql
+			self.__count = self.__connection.execute(cmd).fetchone()[0]
+		
+		return self.__count
+
+	def col_count(self):
+		return len(self.__cursor.description or [])
+
+	def col_type(self, column):
+		if self.__types is None:
+			self.__types = self.get_declared_types()
+		
+		return self.__types[column - 1]
+
+	def get_declared_types(self):
+		# the types of the table definition, as the DBMS gives them even for NULL values
+		declared = {}
+		match = self.table_pattern.search(self.__sql)
+		if match:
+			for row in self.__connection.execute("PRAGMA table_info(%s)" % match.group(1)):
+				declared[row[1].lower()] = row[2].lower()
+		
+		types = []
+		for description in self.__cursor.description or []:
+			column_type = declared.get(description[0].lower(), "")
+			if column_type.find("int") >= 0 or column_type.find("counter") >= 0:
+				types.append(5) # EDbColInt32
+			elif column_type.find("binary") >= 0:
+				types.append(16) # EDbColLongBinary
+			else:
+				types.append(12) # EDbColText16
+		
+		return types
+
+	def col(self, column):
+		return self.__row[column - 1]
+
+
 class DbHelper(object):
-	def __init__(self, dbpath, file_system_services):
+	repeated_queries_size = 8
+
+	def __init__(self, dbpath, file_system_services, backend=None):
 		self.__db_path = dbpath
 		self.__fs_services = file_system_services
 		db_already_exists = self.__fs_services.exists(self.__db_path) 
 		
-		self.db = e32db.Dbms()
-		self.dbv = e32db.Db_view()
+		self.db = backend or self.create_backend()
+		# views of the last queries, reused only when the same SQL with the same 
+		# values is read again, e.g. the albums of an artist when going back to them
+		self.repeated_queries = LruCache(self.repeated_queries_size)
 		
 		if db_already_exists:
 			self.db.open(unicode(dbpath))
@@ -1092,6 +3000,14 @@ class DbHelper(object):
 			self.db.create(unicode(dbpath))
 			self.db.open(unicode(dbpath))
 			self.create_tables()
+		
+		self.migrate()
+
+	def create_backend(self):
+		if e32db:
+			return E32DbBackend()
+		
+		return Sqlite3Backend()
 
 	def close(self):
 		self.db.close()
@@ -1099,30 +3015,103 @@ class DbHelper(object):
 	def check_db_directory(self):
 		self.__fs_services.create_base_directories_for(self.__db_path)
 
-	def execute_nonquery(self, sql):
-		return self.db.execute(unicode(sql))
+	def execute_nonquery(self, sql, params=()):
+		self.repeated_queries.clear() # the views would not see the change
+		return self.db.execute(self.format(sql, params))
 
-	def execute_reader(self, sql):
-		self.dbv.prepare(self.db, unicode(sql))
-		self.dbv.first_line()
-		result = []
+	def begin(self):
+		self.db.begin()
+
+	def commit(self):
+		self.db.commit()
+
+	def rollback(self):
+		self.repeated_queries.clear()
+		self.db.rollback()
+
+	def format(self, sql, params=()):
+		# DBMS SQL has no bound parameters, so each ? is replaced by a quoted literal
+		parts = sql.split("?")
+		assert len(parts) == len(params) + 1, "Wrong number of parameters for: %s" % sql
 		
-		for i in range(self.dbv.count_line()):
-			self.dbv.get_line()
-			row = []
-			
-			for i in range(self.dbv.col_count()):
-				try:
-					row.append(self.dbv.col(i+1))
-				except:    # in case coltype 16
-					row.append(None)
-			
-			result.append(row)
-			self.dbv.next_line()
+		result = [parts[0]]
+		for i in range(len(params)):
+			result.append(self.quote(params[i]))
+			result.append(parts[i + 1])
 		
-		return result
+		return unicode("".join(result))
+
+	def quote(self, value):
+		if value is None:
+			return u"NULL"
+		elif isinstance(value, (int, long)):
+			return u"%i" % value
+		
+		return u"'%s'" % unicode(value).replace("'", "''")
+
+	def prepare_view(self, sql):
+		view = self.repeated_queries.get(sql)
+		if view is None:
+			view = self.db.prepare(sql)
+			self.repeated_queries.put(sql, view)
+		
+		return view
+
+	def execute_reader(self, sql, params=()):
+		return DbCursor(self.prepare_view(self.format(sql, params))).fetch_all()
+
+	def cursor(self, sql, params=()):
+		# the view of a cursor is read lazily, so it is not shared through the cache
+		return DbCursor(self.db.prepare(self.format(sql, params)))
+
+	def delete_all(self, table, column, values, batch_size=50, transaction=None):
+		# DBMS SQL has no IN operator, so the values are deleted in OR batches
+		for start in range(0, len(values), batch_size):
+			batch = values[start:start + batch_size]
+			conditions = ["%s = ?" % column] * len(batch)
+			cmd = "DELETE FROM %s WHERE %s" % (table, " OR ".join(conditions))
+			if transaction:
+				transaction.execute(cmd, batch)
+			else:
+				self.execute_nonquery(cmd, batch)
+
+	def has_column(self, table, column):
+		try:
+			self.db.prepare(unicode("SELECT %s FROM %s" % (column, table)))
+			return True
+		except:
+			return False
+
+	def get_migrations(self):
+		# the schema version is the number of steps already run, so new steps 
+		# go to the end of the list. A step may be run again if it was 
+		# interrupted, so each one checks what is already there.
+		return [self.add_music_tags_columns,
+				self.create_scan_directory_table,
+				self.create_library_stats_table,
+				self.add_music_name_tables,
+				self.create_music_indexes,
+				self.create_search_index,
+				self.add_music_history_id,
+				self.normalize_root_music_paths,
+				self.create_journal_applied_table,
+				self.add_music_title_key]
+
+	def get_schema_version(self):
+		if not self.has_column("Schema_Version", "Version"):
+			self.execute_nonquery("CREATE TABLE Schema_Version (Version integer)")
+			self.execute_nonquery("INSERT INTO Schema_Version (Version) VALUES(0)")
+		
+		return self.execute_reader("SELECT Version FROM Schema_Version")[0][0]
+
+	def migrate(self):
+		migrations = self.get_migrations()
+		for version in range(self.get_schema_version(), len(migrations)):
+			migrations[version]()
+			self.execute_nonquery("UPDATE Schema_Version SET Version = ?", (version + 1,))
 
 	def create_tables(self):
+		# tables of the first version, the migrations bring them up to date
 		self.create_music_history_table()
 		self.create_user_table()
 		self.create_music_table()
@@ -1131,6 +3120,153 @@ class DbHelper(object):
 		cmd = "CREATE TABLE Music (Path varchar(200), Artist varchar(200), Album varchar(200))"
 		self.execute_nonquery(cmd)
 	
+	def add_columns(self, table, columns):
+		for column in columns:
+			if not self.has_column(table, column.split()[0]):
+				self.execute_nonquery("ALTER TABLE %s ADD %s" % (table, column))
+
+	def create_table(self, table, columns):
+		if not self.has_column(table, columns[0].split()[0]):
+			self.execute_nonquery("CREATE TABLE %s (%s)" % (table, ", ".join(columns)))
+
+	def add_music_tags_columns(self):
+		self.add_columns("Music", ["Title varchar(200)", "Year varchar(10)", 
+				"Comment varchar(200)", "TrackNumber integer", "TrackLength integer", 
+				"FileSize integer", "FileModified integer"])
+	
+	def add_music_name_tables(self):
+		# the names are still kept in the Music table, as there are no joins to 
+		# read them from the Artist and Album tables
+		self.add_columns("Music", ["ArtistId integer", "AlbumId integer"])
+		self.create_table("Artist", ["Id integer", "Name varchar(200)"])
+		self.create_table("Album", ["Id integer", "Name varchar(200)"])
+		self.migrate_music_names("Artist", "ArtistId")
+		self.migrate_music_names("Album", "AlbumId")
+		self.execute_nonquery("DELETE FROM Library_Stats")
+
+	def create_music_indexes(self):
+		indexes = [("Artist_Id", "Artist", "Id"), ("Artist_Name", "Artist", "Name"), 
+				("Album_Id", "Album", "Id"), ("Album_Name", "Album", "Name"), 
+				("Music_ArtistId", "Music", "ArtistId"), ("Music_AlbumId", "Music", "AlbumId"),
+				("Music_Path", "Music", "Path"), ("Music_Title", "Music", "Title, Path")]
+		for name, table, columns in indexes:
+			self.create_index(name, table, columns)
+
+	def create_search_index(self):
+		self.create_table("Search_Token", ["Token varchar(50)", "Path varchar(200)"])
+		self.create_index("Search_Token_Token", "Search_Token", "Token")
+		self.create_index("Search_Token_Path", "Search_Token", "Path")
+		
+		# the musics already in the library are indexed
+		self.execute_nonquery("DELETE FROM Search_Token")
+		search_index = SearchIndexRepository(self)
+		batch = BatchTransaction(self)
+		for row in self.execute_reader("SELECT Path, Title, Artist, Album FROM Music"):
+			search_index.save(row[0], row[1:], batch)
+		batch.commit()
+
+	def add_music_history_id(self):
+		self.add_columns("Music_History", ["Id integer"])
+		# plays saved before get one id each in the order they were played, after 
+		# the ones an interrupted run already numbered. Plays of the same second 
+		# cannot be told apart by an UPDATE, so they are inserted again.
+		history_id = 0
+		for row in self.execute_reader("SELECT Id FROM Music_History WHERE Id IS NOT NULL"):
+			history_id = max(history_id, row[0])
+		
+		cmd = "SELECT Artist, Track, PlayedAt, Album, TrackLength FROM Music_History " + \
+			"WHERE Id IS NULL ORDER BY PlayedAt"
+		rows = self.execute_reader(cmd)
+		if rows:
+			cmd = "INSERT INTO Music_History (Id, Artist, Track, PlayedAt, Album, TrackLength) " + \
+				"VALUES(?, ?, ?, ?, ?, ?)"
+			batch = BatchTransaction(self, None)
+			try:
+				batch.execute("DELETE FROM Music_History WHERE Id IS NULL")
+				for row in rows:
+					history_id += 1
+					batch.execute(cmd, [history_id] + list(row))
+				batch.commit()
+			except:
+				batch.rollback()
+				raise
+		
+		self.create_index("Music_History_Id", "Music_History", "Id")
+
+	def normalize_root_music_paths(self):
+		# os.path.walk scans stored the files of a drive root with a doubled separator
+		paths = [row[0] for row in self.cursor("SELECT Path FROM Music") 
+				if row[0] and row[0][1:4] == u":\\\\"]
+		for path in paths:
+			params = (path[:2] + path[3:], path)
+			self.execute_nonquery("UPDATE Music SET Path = ? WHERE Path = ?", params)
+			self.execute_nonquery("UPDATE Search_Token SET Path = ? WHERE Path = ?", params)
+
+	def create_journal_applied_table(self):
+		# sequence number of the last journaled play saved in Music_History
+		self.create_table("Journal_Applied", ["Seq integer"])
+		if not self.execute_reader("SELECT Seq FROM Journal_Applied"):
+			self.execute_nonquery("INSERT INTO Journal_Applied (Seq) VALUES(0)")
+
+	def add_music_title_key(self):
+		# the all musics pages are read in the order of MusicCatalog.sort_by_title
+		self.add_columns("Music", ["TitleKey varchar(201)"])
+		cmd = "SELECT Path, Title FROM Music WHERE TitleKey IS NULL AND Title IS NOT NULL"
+		rows = [row for row in self.cursor(cmd)]
+		batch = BatchTransaction(self, None)
+		try:
+			for path, title in rows:
+				batch.execute("UPDATE Music SET TitleKey = ? WHERE Path = ?", 
+							(MusicCatalog.title_key(title), path))
+			batch.commit()
+		except:
+			batch.rollback()
+			raise
+		
+		self.create_index("Music_TitleKey", "Music", "TitleKey, Path")
+
+	def create_index(self, name, table, columns):
+		try:
+			self.execute_nonquery("CREATE INDEX %s ON %s (%s)" % (name, table, columns))
+		except Exception, error:
+			# the index may have been created by an interrupted run of the migration
+			if not self.db.already_exists(error):
+				raise
+
+	def migrate_music_names(self, table, id_column):
+		# only the musics without id are updated, so an interrupted run goes on 
+		# with the names already inserted
+		name_ids = {}
+		name_id = 0
+		for row in self.execute_reader("SELECT Id, Name FROM %s" % table):
+			name_ids[row[1]] = row[0]
+			name_id = max(name_id, row[0])
+		
+		rows = self.execute_reader("SELECT %s FROM Music WHERE %s IS NULL" % (table, id_column))
+		names = {}
+		for row in rows:
+			names[row[0] or u""] = True
+		
+		for name in names.keys():
+			if not name_ids.has_key(name):
+				name_id += 1
+				name_ids[name] = name_id
+				self.execute_nonquery("INSERT INTO %s (Id, Name) VALUES(?, ?)" % table, 
+									(name_id, name))
+			condition = "%s = ?" % table
+			if not name:
+				condition += " OR %s IS NULL" % table
+			self.execute_nonquery("UPDATE Music SET %s = ? WHERE %s IS NULL AND (%s)" 
+								% (id_column, id_column, condition), (name_ids[name], name))
+
+	def create_scan_directory_table(self):
+		self.create_table("Scan_Directory", ["Path varchar(200)", "Parent varchar(200)", 
+				"Modified integer"])
+
+	def create_library_stats_table(self):
+		self.create_table("Library_Stats", ["Musics integer", "Artists integer", 
+				"Albums integer"])
+
 	def create_music_history_table(self):
 		cmd = "CREATE TABLE Music_History (Artist varchar(200), Track varchar(200), PlayedAt integer, Album varchar(200), TrackLength integer)"
 		self.execute_nonquery(cmd)
@@ -1185,6 +3321,7 @@ class ScreenNavigator(object):
 		self.__artist_musics_window = None
 		self.__current_history_window = None
 		self.__now_playing_window = None
+		self.__search_window = None
 
 	def go_to_last(self):
 		if self.__last_window == self.__now_playing_window:
@@ -1239,7 +3376,14 @@ class ScreenNavigator(object):
 		
 		self.go_to(self.__albums_window)
 
-	def go_to_musics(self, musics=None, musics_comparer=None):
+	def go_to_search_window(self):
+		if not self.__search_window:
+			self.__search_window = SearchWindow(self.__quit_handler, self, self.__service_locator)
+		
+		if self.__search_window.search():
+			self.go_to(self.__search_window)
+
+	def go_to_musics(self, musics=None, sort_by_number=False):
 		if not self.__musics_window:
 			self.__musics_window = MusicsWindow(self.__quit_handler, self)
 		
@@ -1248,8 +3392,7 @@ class ScreenNavigator(object):
 		else:
 			assert self.__musics_window.musics
 		
-		if musics_comparer != None:
-			self.__musics_window.musics_comparer = musics_comparer
+		self.__musics_window.sort_by_number = sort_by_number
 		
 		self.go_to(self.__musics_window)
 
@@ -1371,9 +3514,14 @@ class MainWindow(Window):
 		Window.__init__(self, quit_handler, navigator)
 		self.__fs_services = service_locator.file_system_services
 		self.__music_repository = service_locator.music_repository
+		self.__scan_directory_repository = service_locator.scan_directory_repository
+		self.__scanning = False
 		self.body = self.create_listbox(self.get_list_items(), self.go_to)
 	
 	def go_to(self):
+		if self.__scanning:
+			return
+		
 		index = self.body.current()
 		if index == 0:
 			self.navigator.go_to_select_window()
@@ -1387,19 +3535,37 @@ class MainWindow(Window):
 		return items
 	
 	def update_music_library(self):
-		self.show_message("This operation can take some time...")
-		result = self.__music_repository.update_library(self.get_all_music_files_path())
-		self.body.set_list(self.get_list_items())
-		self.show_message("Library updated. Added: %i, Deleted: %i" % result)
+		result = self.scan_music_library(self.__music_repository.update_library, True)
+		self.show_message("Library updated. Added: %i, Updated: %i, Deleted: %i" % result)
 	
 	def rebuild_music_library(self):
+		result = self.scan_music_library(self.__music_repository.rebuild_library, False)
+		self.show_message("Library rebuilt. Added: %i" % result)
+
+	def scan_music_library(self, scan, use_cache):
+		# the progress yields to the UI scheduler while the library transaction 
+		# is open, so the menu, the list and the exit key are off until it ends
 		self.show_message("This operation can take some time...")
-		result = self.__music_repository.rebuild_library(self.get_all_music_files_path())
+		self.__scanning = True
+		self.update_menu([])
+		self.set_right_key_handler(lambda: None)
+		directory_cache = self.__scan_directory_repository.load_cache(use_cache)
+		try:
+			result = scan(self.get_all_music_files_path(directory_cache), self.show_progress)
+		finally:
+			self.__scanning = False
+			appuifw.app.title = self.title
+			self.show()
+		self.__scan_directory_repository.save_cache(directory_cache)
 		self.body.set_list(self.get_list_items())
-		self.show_message("Library rebuilt. Added: %i" % result)
+		return result
 
-	def get_all_music_files_path(self):
-		return self.__fs_services.get_all_music_files_path_in_device()
+	def show_progress(self, files_count):
+		appuifw.app.title = u"%i files processed" % files_count
+		e32.ao_yield()
+
+	def get_all_music_files_path(self, directory_cache):
+		return self.__fs_services.get_all_music_files_path_in_device(directory_cache)
 	
 	def get_menu_items(self):
 		items = [
@@ -1428,7 +3594,8 @@ class SelectWindow(Window):
 	def get_list_items(self):
 		items = [(u"All Music", unicode("%i musics" % self.__music_repository.count_all())), 
 				(u"Artists", u"%i artists" % self.__music_repository.count_all_artists()),
-				(u"Albums", u"%i albums" % self.__music_repository.count_all_albums())]
+				(u"Albums", u"%i albums" % self.__music_repository.count_all_albums()),
+				(u"Search", u"Title, artist or album")]
 		return items
 
 	def back(self):
@@ -1448,12 +3615,26 @@ class SelectWindow(Window):
 			self.navigator.go_to_all_musics_window()
 		elif index == 1:
 			self.navigator.go_to_artists_window()
-		else:
+		elif index == 2:
 			self.navigator.go_to_albums_window()
+		else:
+			self.navigator.go_to_search_window()
 
 	def show(self):
 		self.body.set_list(self.get_list_items())
 		self.set_right_key_handler(self.back)
+		self.prune_missing_musics()
+
+	def prune_missing_musics(self):
+		missing = self.__music_repository.count_missing()
+		if not missing:
+			return
+		
+		if self.confirm("%i musics were not found. Remove them from the library?" % missing):
+			self.__music_repository.prune_missing()
+			self.body.set_list(self.get_list_items())
+		else:
+			self.__music_repository.forget_missing()
 
 
 class MusicsWindow(Window):
@@ -1465,32 +3646,19 @@ class MusicsWindow(Window):
 		
 		self.body = self.create_listbox([u"empty"], self.go_to)
 		self.menu = self.get_menu_items()
-		self.musics = []
-		self.musics_comparer = self.title_comparer
+		self.musics = MusicCatalog()
+		self.sort_by_number = False
 
 	def get_list_items(self):
-		list_items = []
-		
 		self.sort_musics()
-		
-		i = 1
-		for music in self.musics:
-			list_items.append(u"%i-%s" % (i, music.title))
-			i += 1
-		
-		return list_items
-	
-	def title_comparer(self, x, y):
-		if x.title.startswith(".."):
-			return 1
-		elif y.title.startswith(".."):
-			return -1
-		else:
-			return cmp(x.title.upper(), y.title.upper())
+		return [u"%i-%s" % (i + 1, self.musics.title(i)) for i in range(len(self.musics))]
 	
 	def sort_musics(self):
-		self.musics.sort(self.musics_comparer)
-		self.musics_comparer = self.title_comparer
+		if self.sort_by_number:
+			self.musics.sort_by_number()
+		else:
+			self.musics.sort_by_title()
+		self.sort_by_number = False
 	
 	def back(self):
 		self.navigator.go_to_select_window()
@@ -1513,14 +3681,73 @@ class MusicsWindow(Window):
 
 
 class AllMusicsWindow(MusicsWindow):
+	page_size = 50
+
 	def __init__(self, quit_handler, navigator, service_locator):
 		MusicsWindow.__init__(self, quit_handler, navigator)
 		self.__music_repository = service_locator.music_repository
+		self.__next_page = None
+		self.body.bind(EKeyDownArrow, self.load_page_if_needed)
 	
+	def sort_musics(self):
+		pass # the pages come ordered by title from the repository
+
+	def load_next_page(self):
+		self.__next_page = self.__music_repository.find_page_by_title(self.musics, 
+											self.__next_page, self.page_size)
+
+	def load_page_if_needed(self):
+		# the next page is loaded when the cursor gets close to the end of the list
+		if self.__next_page and self.body.current() >= len(self.musics) - 5:
+			current = self.body.current()
+			self.load_next_page()
+			self.body.set_list(self.get_list_items(), current)
+
+	def go_to(self):
+		# the whole library is played, not only the musics seen so far
+		if self.__next_page:
+			self.__next_page = self.__music_repository.find_page_by_title(self.musics, 
+											self.__next_page, None)
+		MusicsWindow.go_to(self)
+
 	def show(self):
-		self.musics = self.__music_repository.find_all()
+		self.musics = MusicCatalog()
+		self.__next_page = None
+		self.load_next_page()
 		MusicsWindow.show(self)
 
+
+class SearchWindow(MusicsWindow):
+	def __init__(self, quit_handler, navigator, service_locator):
+		MusicsWindow.__init__(self, quit_handler, navigator)
+		self.__music_repository = service_locator.music_repository
+	
+	def search(self):
+		text = self.ask_text("Search (e.g. 'blo par'):")
+		if not text:
+			return False
+		
+		musics = self.__music_repository.search(text)
+		if not musics:
+			self.show_message("No musics found for '%s'" % text)
+			return False
+		
+		self.musics = musics
+		return True
+
+	def new_search(self):
+		if self.search():
+			self.show()
+
+	def get_menu_items(self):
+		items = [
+			(u"New search", self.new_search),
+			(u"Back", self.back),
+			(u"Now playing", self.navigator.go_to_now_playing)]
+		items.extend(self.basic_last_menu_items())
+
+		return items
+
 		
 class ArtistsWindow(Window):
 	def __init__(self, quit_handler, navigator, service_locator):
@@ -1570,16 +3797,16 @@ class ArtistMusicsWindow(Window):
 
 	def go_to(self):
 		index = self.body.current()
-		comparer = None
+		sort_by_number = False
 		if index == 0:
 			musics = self.__music_repository.find_all_by_artist(self.artist)
 		else:
 			album_selected = self.albums[index]
 			musics = self.__music_repository.find_all_musics_artist_album(self.artist, album_selected)
-			comparer = lambda x, y: cmp(x.number, y.number)
+			sort_by_number = True
 
 		assert musics
-		self.navigator.go_to_musics(musics, comparer)
+		self.navigator.go_to_musics(musics, sort_by_number)
 
 	def get_list_items(self):
 		assert self.artist
@@ -1643,7 +3870,7 @@ class AlbumsWindow(Window):
 		album_selected = self.albums[index]
 		musics = self.__music_repository.find_all_by_album(album_selected)
 		assert musics
-		self.navigator.go_to_musics(musics, lambda x, y: cmp(x.number, y.number))
+		self.navigator.go_to_musics(musics, True)
 
 	def show(self):
 		self.body.set_list(self.get_list_items())
@@ -1772,12 +3999,12 @@ class NowPlayingWindow(Window):
 class CurrentHistoryWindow(Window):
 	def __init__(self, quit_handler, navigator, service_locator):
 		Window.__init__(self, quit_handler, navigator)
-		self.__music_history_repository = service_locator.history_repository
+		self.__music_history = service_locator.music_history
 		self.body = self.create_listbox([(u"empty", u"empty")], self.go_to)
 		self.menu = self.get_menu_items()
 
 	def get_list_items(self):
-		self.history = self.__music_history_repository.load_all_history()
+		self.history = self.__music_history.load_all_history()
 		if not self.history:
 			return [(u"empty", u"empty")]
 		
@@ -1856,7 +4083,7 @@ class NowPlayingPresenter(object):
 
 	def show_current_volume(self):
 		self.view.show_message("Current volume: %s%%" % (
-						self.music_list.current_music.player.current_volume_percentage()))
+						self.music_list.current_music.get_player().current_volume_percentage()))
 		
 	def volume_down(self):
 		if self.music_list:	
@@ -1870,7 +4097,9 @@ class AudioScrobblerPresenter(object):
 		self.__ap_services = AccessPointServices()
 		self.__music_history = service_locator.music_history
 		self.__audio_scrobbler_service = service_locator.as_service
-		self.__now_playing_error_counter = 0
+		self.__submitter = service_locator.scrobble_submitter
+		self.__submitter.status_handler = self.scrobble_status
+		self.__now_playing = NowPlayingDispatcher(self.__audio_scrobbler_service)
 		self.__wanna_connect = False
 
 	def close(self):
@@ -1898,10 +4127,15 @@ class AudioScrobblerPresenter(object):
 
 	def clear_as_db(self):
 		if self.view.confirm("Are you sure you want to clear your history?"):
-			self.__music_history.clear()
+			self.clear_history()
+	
+	def clear_history(self):
+		self.__submitter.clear()
+		self.__music_history.clear()
 	
 	def disconnect(self):
 		self.__wanna_connect = False
+		self.__audio_scrobbler_service.close_connections()
 		self.__ap_services.close()
 	
 	def connect(self):
@@ -1939,7 +4173,7 @@ class AudioScrobblerPresenter(object):
 		
 		if self.__audio_scrobbler_service.user_changed(user_name):
 			if self.view.confirm("The username changed. The previous user music history will be removed. Proceed?"):
-				self.__music_history.clear()
+				self.clear_history()
 			else:
 				return
 			
@@ -1948,8 +4182,24 @@ class AudioScrobblerPresenter(object):
 		
 	def send_history(self):
 		if self.__wanna_connect:
-			if self.online_operation(self.__music_history.send_to_audioscrobbler):
-				self.view.show_message("History sent")
+			self.__submitter.submit()
+			self.view.show_message("Sending history")
+	
+	def scrobble_status(self, sent, failures, error=None):
+		# the errors of the worker are handled as the ones of connect
+		if isinstance(error, NoAudioScrobblerUserError):
+			self.create_as_credentials()
+		elif isinstance(error, AudioScrobblerCredentialsError):
+			self.view.show_error_message("Bad Username/Password. Change your credentials")
+		elif isinstance(error, AudioScrobblerWaitError):
+			self.view.show_error_message(error)
+		elif isinstance(error, (IOError, socket.error)):
+			if self.view.confirm("Connection failed. Wanna try again?"):
+				self.__submitter.submit()
+			else:
+				self.__wanna_connect = False
+		elif failures == 1:
+			self.view.show_error_message("It was not possible to send the history to Last.fm")
 	
 	def show_cannot_connect(self):
 		self.view.show_error_message("It was not possible to connect!")
@@ -1960,19 +4210,17 @@ class AudioScrobblerPresenter(object):
 
 	def finished_music(self, music):
 		if self.__wanna_connect:
-			self.online_operation(self.__music_history.send_to_audioscrobbler)
+			self.__submitter.submit()
 	
 	def add_to_history(self, music):
 		self.__music_history.add_music(music)
 	
 	def audio_scrobbler_now_playing(self, music):
 		if self.__wanna_connect:
-			if not self.online_operation(lambda: self.__audio_scrobbler_service.now_playing(music)):
-				self.__now_playing_error_counter += 1
-				if self.__now_playing_error_counter % 30 == 0:
-					self.view.show_message("It was not possible to send now playing to Last.fm")
-			else:
-				self.__now_playing_error_counter = 0
+			dropped = self.__now_playing.dropped
+			self.__now_playing.update(music)
+			if self.__now_playing.dropped > dropped:
+				self.view.show_message("It was not possible to send now playing to Last.fm")
 
 
 class AccessPointServices(object):
@@ -2135,6 +4383,20 @@ class FileSystemServicesFixture(AspyFixture):
 		self.assertEquals(14, len(files), "Num of files loaded")
 
 		self.assertEquals("E:\\data\\aspyplayer\\aspyplayer.db", fss.get_db_file_path(), "DB file path")
+		
+		fss = FileSystemServices(["E:\\"], ["?:\\system", "*\\cache"])
+		self.assertTrue(fss.is_excluded(u"E:\\System"), "Excluded root directory")
+		self.assertTrue(fss.is_excluded(u"E:\\Music\\Cache"), "Excluded sub directory")
+		self.assertTrue(not fss.is_excluded(u"E:\\Music"), "Not excluded directory")
+		
+		cache = DirectoryScanCache({u"E:\\Music": (u"E:\\", 10), u"E:\\Music\\A": (u"E:\\Music", 20)},
+								[u"E:\\Music\\1.mp3"])
+		self.assertEquals(([u"E:\\Music\\1.mp3"], [u"E:\\Music\\A"]), 
+						cache.get(u"E:\\Music", 10), "Unchanged directory uses the cache")
+		self.assertTrue(cache.get(u"E:\\Music", 11) == None, "Changed directory is listed")
+		cache.visit(u"E:\\Music", u"E:\\", 11)
+		self.assertEquals([u"E:\\Music\\A"], cache.get_vanished(), "Directories not visited")
+		self.assertEquals((u"E:\\", 11), cache.changed[u"E:\\Music"], "Changed directories")
 
 
 class MusicHistoryRepositoryFixture(AspyFixture):		
@@ -2189,6 +4451,12 @@ class MusicFixture(AspyFixture):
 		music.length = 261
 		music.get_player_position_in_seconds = lambda: 135
 		self.assertTrue(music.can_be_added_to_history(), "Can add to history")
+		
+		lazy_music = Music(music.file_path, False)
+		lazy_music.artist = u"Bloc Party"
+		self.assertTrue(lazy_music.player == None, "No player before playing")
+		self.assertTrue(not lazy_music.__dict__.has_key("title"), "Tags not read on creation")
+		self.assertEquals(u"Like Eating Glass", unicode(lazy_music.title), "Tags read on first use")
 
 #		music_test = Music("E:\\Music\\Kasabian - Empire\\03 - Last Trip (In Flight).mp3");
 #		self.assertEquals("Last Trip (In Flight)", music_test.title, "UUUU... teste")
@@ -2272,54 +4540,278 @@ class FakePlayer(object):
 	def state(self):
 		return 2
 
+class FakeDbHelper(DbHelper):
+	def __init__(self):
+		self.statements = []
+	
+	def execute_nonquery(self, sql, params=()):
+		self.statements.append(params)
+		return 1
+
 class MusicHistoryFixture(AspyFixture):
 	def __init__(self):
 		AspyFixture.__init__(self)
 		self.title = "Music history tests"
 
 	def run(self):
-		self.music_history_tests()
-		self.send_batches_tests()
+		self.remove_musics_tests()
+		self.journal_tests()
 	
-	def music_history_tests(self):
-		ms = []
-		for i in range(10):
-			ms.append(self.load_music())
-		
-		repos = MusicHistoryRepository(None)
-		repos.load_all_history = lambda: ms
-		repos.clear_history = lambda: None
+	def remove_musics_tests(self):
+		db_helper = FakeDbHelper()
+		deletes = db_helper.statements
+		repos = MusicHistoryRepository(db_helper)
+		musics = []
+		for i in [4, 2, 3]:
+			music = Music()
+			music.history_id = i
+			musics.append(music)
 		
-		as_service = AudioScrobblerService(None)
-		empty = []
-		as_service.send = lambda musics:empty.append(1)
+		repos.remove_musics(musics)
+		self.assertEquals(deletes.pop(), (2, 4), "Sequence removed by range")
 		
-		m_h = MusicHistory(repos, as_service)
-		m_h.send_to_audioscrobbler()
+		musics[0].history_id = 7
+		repos.remove_musics(musics)
+		self.assertEquals(deletes.pop(), [2, 3, 7], "Gaps removed in one statement")
+		self.assertEquals(len(deletes), 0, "One delete per batch")
+	
+	def journal_tests(self):
+		path = "%sdata\\aspyplayer\\test_scrobbles.log" % FileSystemServices().get_data_drive()
+		journal = ScrobbleJournal(path)
+		journal.truncate()
+		journal.next_seq = 1
+		for i in range(4):
+			music = Music()
+			music.artist = u"Bloc Party"
+			music.title = u"Title\t%i" % i
+			music.played_at = 1000 + i / 2
+			journal.append(music)
+		self.assertEquals(4, journal.syncs, "Each play synced when written")
+		journal.close()
+		
+		f = open(path, "ab")
+		f.write("5\t1004\t0\tBloc")
+		f.close()
 		
-		self.assertTrue(len(empty) > 0, "Simple send expected")
+		journal = ScrobbleJournal(path)
+		journal.next_seq = 5
+		journal.append(music)
+		musics = journal.read_all()
+		self.assertEquals(5, len(musics), "Torn play ignored")
+		self.assertEquals(u"Title 2", musics[2].title, "Separators replaced")
+		self.assertEquals(1001, musics[2].played_at, "Play time read back")
+		self.assertEquals([1, 2, 3, 4, 5], [music.journal_seq for music in musics], 
+						"Plays of the same second numbered apart")
+		
+		journal.truncate()
+		self.assertEquals([], journal.read_all(), "Journal truncated")
+	
+
+class FakeMusicHistory(object):
+	def __init__(self, count):
+		self.musics = []
+		for i in range(count):
+			music = Music()
+			music.history_id = i + 1
+			self.musics.append(music)
+		self.removed = []
+	
+	def load_history_after(self, history_id):
+		return [music for music in self.musics if music.history_id > history_id]
+	
+	def remove_sent(self, musics):
+		self.removed.extend(musics)
+
+class ScrobbleSubmitterFixture(AspyFixture):
+	def __init__(self):
+		AspyFixture.__init__(self)
+		self.title = "ScrobbleSubmitter tests"
+
+	def run(self):
+		self.submit_tests()
+		self.errors_tests()
+	
+	def submit_tests(self):
+		history = FakeMusicHistory(135)
+		results = [True, False, True, True]
+		batches = []
+		as_service = AudioScrobblerService(None)
+		as_service.send = lambda musics: batches.append(len(musics)) or results.pop(0)
+		statuses = []
+		
+		submitter = ScrobbleSubmitter(history, as_service, 
+									lambda sent, failures, error: statuses.append((sent, failures)))
+		submitter.submit()
+		self.wait_for(statuses, 2)
+		self.assertEquals([50, 50], batches, "Stopped after a failed batch")
+		self.assertEquals([(50, 0), (50, 1)], statuses, "Status reported")
+		self.assertEquals(history.musics[:50], history.removed, "Sent batch removed")
+		
+		submitter.submit()
+		self.wait_for(statuses, 4)
+		self.assertEquals([50, 50, 50, 35], batches, "Failed batch retried on the next submit")
+		self.assertEquals(135, len(history.removed), "All history removed")
+		self.assertEquals(0, submitter.failures, "Failures reset")
+		submitter.stop()
+	
+	def errors_tests(self):
+		def send(musics):
+			raise AudioScrobblerCredentialsError("Bad username/password")
 		
+		as_service = AudioScrobblerService(None)
+		as_service.send = send
+		errors = []
+		submitter = ScrobbleSubmitter(FakeMusicHistory(10), as_service, 
+									lambda sent, failures, error: errors.append(error))
+		submitter.submit()
+		self.wait_for(errors, 1)
+		self.assertTrue(isinstance(errors[0], AudioScrobblerCredentialsError), 
+						"Credentials error reported to the UI thread")
+		submitter.stop()
+	
+	def wait_for(self, statuses, count):
 		for i in range(50):
-			ms.append(self.load_music())
+			if len(statuses) >= count:
+				break
+			e32.ao_sleep(0.1)
+
+
+class HttpConnectionPoolFixture(AspyFixture):
+	def __init__(self):
+		AspyFixture.__init__(self)
+		self.title = "HttpConnectionPool tests"
+
+	def create_stand_in_server(self):
+		# imported here, the application itself does not need an HTTP server
+		import BaseHTTPServer
+		
+		class StandInHttpHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+			protocol_version = "HTTP/1.1"
+			
+			def do_GET(self):
+				self.reply("GET %s" % self.path)
+			
+			def do_POST(self):
+				body = self.rfile.read(int(self.headers["Content-Length"]))
+				if self.path == "/drop": # received, but the connection is lost
+					self.server.dropped += 1
+					self.close_connection = 1
+				else:
+					self.reply(body)
+			
+			def reply(self, body):
+				self.server.clients.append(self.client_address)
+				self.send_response(self.path == "/missing" and 404 or 200)
+				self.send_header("Content-Length", str(len(body)))
+				if self.path == "/close":
+					self.send_header("Connection", "close")
+				self.end_headers()
+				self.wfile.write(body)
+			
+			def log_message(self, format, *args):
+				pass
 		
-		empty.pop()
-		old_method = m_h.send_batches_to_audioscrobbler
-		m_h.send_batches_to_audioscrobbler = lambda musics: None
+		server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), StandInHttpHandler)
+		server.clients = []
+		server.dropped = 0
+		return server
 
-		m_h.send_to_audioscrobbler()
+	def run(self):
+		server = self.create_stand_in_server()
+		thread.start_new_thread(self.serve, (server, 3))
+		url = "http://127.0.0.1:%i" % server.server_address[1]
+		
+		pool = HttpConnectionPool()
+		self.assertEquals("GET /np?s=1", pool.request(url + "/np?s=1"), "GET request")
+		self.assertEquals("a=1&b=2", pool.request(url + "/post", "a=1&b=2"), "POST request")
+		self.assertEquals(1, pool.connections_opened, "Connection kept alive")
 		
-		self.assertTrue(len(empty) == 0, "Batch expected")
+		pool.request(url + "/close")
+		pool.request(url)
+		self.assertEquals(2, pool.connections_opened, "Reconnected after the server closed")
 		
-	def send_batches_tests(self):
-		musics = [i for i in range(135)]
-		l = []
-		m_h = MusicHistory(None, None)
-		m_h.send_batch = lambda batch: l.append(len(batch))
-		m_h.send_batches_to_audioscrobbler(musics)
-		self.assertTrue(l[0] == 50, "Batch 1")
-		self.assertTrue(l[1] == 50, "Batch 2")
-		self.assertTrue(l[2] == 35, "Batch 3")
+		pool.idle_timeout = 0
+		pool.request(url)
+		self.assertEquals(3, pool.connections_opened, "Idle connection not reused")
+		self.assertEquals(5, pool.requests, "Requests sent")
+		
+		try:
+			pool.request(url + "/missing")
+			self.assertTrue(False, "HTTP error raised")
+		except IOError:
+			pass
+		pool.close()
+		
+		try:
+			pool.request(url)
+			self.assertTrue(False, "Connection error raised")
+		except IOError:
+			pass
+		
+		clients = {}
+		for client in server.clients:
+			clients[client] = True
+		self.assertEquals(3, len(clients), "Connections seen by the server")
+		
+		server = self.create_stand_in_server()
+		thread.start_new_thread(self.serve, (server, 2))
+		url = "http://127.0.0.1:%i" % server.server_address[1]
+		pool = HttpConnectionPool()
+		pool.request(url)
+		try:
+			pool.request(url + "/drop", "a=1")
+			self.assertTrue(False, "Lost response raised")
+		except IOError:
+			pass
+		pool.request(url)
+		self.assertEquals(1, server.dropped, "POST not sent again after it was received")
+		pool.close()
 	
+	def serve(self, server, connections):
+		for i in range(connections):
+			server.handle_request()
+		server.server_close()
+
+
+class NowPlayingDispatcherFixture(AspyFixture):
+	def __init__(self):
+		AspyFixture.__init__(self)
+		self.title = "NowPlayingDispatcher tests"
+
+	def run(self):
+		now = [0]
+		results = []
+		sent = []
+		as_service = AudioScrobblerService(None)
+		as_service.now_playing = lambda music: sent.append(music) or results.pop(0)
+		dispatcher = NowPlayingDispatcher(as_service, lambda: now[0])
+		
+		skipped = Music()
+		dispatcher.update(skipped)
+		music = Music()
+		results.append(True)
+		for position in range(10):
+			music.position = position
+			dispatcher.update(music)
+		self.assertEquals([music], sent, "Sent once after settling")
+		self.assertEquals(1, dispatcher.coalesced, "Skipped music coalesced")
+		
+		music = Music()
+		music.position = 6
+		results.extend([False, False])
+		for i in range(15):
+			now[0] += 1
+			dispatcher.update(music)
+		self.assertEquals(3, len(sent), "Retried after the backoff only")
+		
+		for i in range(60):
+			now[0] += 1
+			results.append(False)
+			dispatcher.update(music)
+		self.assertEquals(5, len(sent), "Given up after the max attempts")
+		self.assertEquals(1, dispatcher.dropped, "Dropped notification")
+		self.assertEquals(1, dispatcher.sent, "Sent notifications")
+
 
 class AudioScrobblerUserRepositoryFixture(AspyFixture):
 	def __init__(self):
@@ -2382,6 +4874,444 @@ class MusicListFixture(AspyFixture):
 		self.assertTrue(ml2.current_music.number != m2.number, "Next is not really the next now (shuffle, sometimes test can fail)")
 		
 
+class MusicCatalogFixture(AspyFixture):
+	def __init__(self):
+		AspyFixture.__init__(self)
+		self.title = "MusicCatalog tests"
+	
+	def run(self):
+		catalog = MusicCatalog()
+		catalog.append(u"E:\\Music\\Muse\\02 - Hysteria.mp3", u"Hysteria", u"Muse", u"Absolution", 2, 227)
+		catalog.append(u"E:\\Music\\Muse\\01 - Intro.mp3", u"..Intro", u"Muse", u"Absolution", 1, 22)
+		catalog.append(u"E:\\Music\\Bj\xf6rk\\Hunter.mp3", u"hunter", u"Bj\xf6rk", u"Homogenic", None, None)
+		
+		self.assertEquals(3, len(catalog), "All musics appended")
+		music = catalog[2]
+		self.assertEquals(u"E:\\Music\\Bj\xf6rk\\Hunter.mp3", music.file_path, "Path rebuilt from dir and file name")
+		self.assertEquals(u"Bj\xf6rk", music.artist, "Artist from the interned values")
+		self.assertEquals(-1, music.number, "Missing number")
+		self.assertEquals(0, music.length, "Missing length")
+
+		catalog.sort_by_title()
+		titles = [catalog.title(i) for i in range(len(catalog))]
+		self.assertEquals([u"hunter", u"Hysteria", u"..Intro"], titles, "Sorted by title, '..' last")
+
+		catalog.sort_by_number()
+		self.assertEquals(u"hunter", catalog[0].title, "Musics without number first")
+		self.assertEquals(2, catalog.number(2), "Sorted by number")
+		
+		ml = MusicList(catalog, None)
+		ml.move_next()
+		self.assertEquals(u"..Intro", ml.current_music.title, "Music list over the catalog")
+		
+
+class DbFixture(AspyFixture):
+	# a new database in the data directory, on the DBMS on the phone and on sqlite3 elsewhere
+	def get_test_path(self, name):
+		return os.path.join(FileSystemServices().get_data_drive() + "data", "aspyplayer", name)
+
+	def create_db_helper(self, helper_class=DbHelper):
+		path = self.get_test_path("test_library.db")
+		if os.path.exists(path):
+			os.remove(path)
+		return helper_class(unicode(path), FileSystemServices())
+
+	def create_music_files(self, names, dirname="test_musics"):
+		# empty files, the musics are saved with their tags
+		dirname = self.get_test_path(dirname)
+		if not os.path.exists(dirname):
+			os.makedirs(dirname)
+		
+		paths = []
+		for name in names:
+			path = os.path.join(dirname, name)
+			open(path, "wb").close()
+			paths.append(unicode(path))
+		return paths
+
+	def create_music(self, path, title, artist=u"Artist", album=u"Album"):
+		music = Music(path, False)
+		music.title = title
+		music.artist = artist
+		music.album = album
+		music.year = music.comment = None
+		music.number = music.length = music.file_size = music.file_mtime = 0
+		return music
+
+
+class MusicPagingFixture(DbFixture):
+	def __init__(self):
+		DbFixture.__init__(self)
+		self.title = "Music paging tests"
+	
+	def run(self):
+		db_helper = self.create_db_helper()
+		repository = MusicRepository(db_helper)
+		titles = [u"b", u"a", u"..03", u"B", u"Same", u"Same", u"c"]
+		paths = self.create_music_files(["%02i.mp3" % (i + 1) for i in range(len(titles))])
+		repository.save_all([self.create_music(paths[i], titles[i]) for i in range(len(titles))])
+		
+		catalog = MusicCatalog()
+		page = None
+		pages = []
+		while 1:
+			page = repository.find_page_by_title(catalog, page, 2)
+			pages.append(len(catalog))
+			if not page:
+				break
+		
+		order = [paths.index(music.file_path) + 1 for music in catalog]
+		self.assertEquals([2, 1, 4, 7, 5, 6, 3], order, "Case insensitive, ties by path, '..' last")
+		self.assertEquals([2, 4, 6, 7], pages, "Pages up to the final short one")
+		
+		catalog = MusicCatalog()
+		page = repository.find_page_by_title(catalog, None, 3)
+		self.assertEquals(None, repository.find_page_by_title(catalog, page, None), "Rest read")
+		self.assertEquals(7, len(catalog), "All musics read with the rest")
+		db_helper.close()
+
+
+class MissingMusicsFixture(DbFixture):
+	def __init__(self):
+		DbFixture.__init__(self)
+		self.title = "Missing musics tests"
+	
+	def run(self):
+		self.listing_tests()
+		self.prune_tests()
+	
+	def listing_tests(self):
+		paths = self.create_music_files(["Found.mp3", "Removed.mp3"], "test_listing")
+		os.remove(paths[1])
+		dirname, name = os.path.split(paths[0])
+		
+		listings = DirectoryListingCache()
+		listings.start()
+		self.assertTrue(listings.exists(paths[0]), "File found")
+		self.assertTrue(listings.exists(os.path.join(dirname, name.upper())), "Name case ignored")
+		self.assertTrue(not listings.exists(paths[1]), "Removed file not found")
+		self.assertTrue(listings.is_listed(paths[1]), "Its directory listed")
+		
+		unreachable = os.path.join(dirname + "_removed_card", name)
+		self.assertTrue(not listings.exists(unreachable), "File of an unreadable directory")
+		self.assertTrue(not listings.is_listed(unreachable), "Unreadable directory not listed")
+	
+	def prune_tests(self):
+		db_helper = self.create_db_helper()
+		repository = MusicRepository(db_helper)
+		paths = self.create_music_files(["01.mp3", "02.mp3", "03.mp3"], "test_prune")
+		unreachable = os.path.join(os.path.split(paths[0])[0] + "_removed_card", "04.mp3")
+		musics = [self.create_music(path, u"Title") for path in paths + [unreachable]]
+		repository.save_all(musics)
+		os.remove(paths[1])
+		
+		found = [music.file_path for music in repository.find_all()]
+		self.assertEquals([paths[0], paths[2]], found, "Only the musics found listed")
+		self.assertEquals(1, repository.count_missing(), "Unreadable directory not missing")
+		self.assertEquals(1, repository.prune_missing(), "Missing music pruned")
+		self.assertEquals(0, repository.count_missing(), "Nothing missing after the prune")
+		self.assertEquals(3, repository.count_all(), "Musics of the unreadable directory kept")
+		
+		repository.find_all()
+		repository.forget_missing()
+		self.assertEquals(0, repository.prune_missing(), "Nothing pruned once forgotten")
+		db_helper.close()
+
+
+class BaselineDbHelper(DbHelper):
+	# the tables of the first version, before the Schema_Version table
+	def migrate(self):
+		pass
+
+
+class MigrationsFixture(DbFixture):
+	def __init__(self):
+		DbFixture.__init__(self)
+		self.title = "Schema migrations tests"
+	
+	def run(self):
+		self.already_exists_tests()
+		self.baseline_tests()
+	
+	def already_exists_tests(self):
+		self.assertTrue(E32DbBackend.already_exists(OSError(-11, "KErrAlreadyExists")), 
+						"Error code of the DBMS")
+		self.assertTrue(E32DbBackend.already_exists(Exception("[Errno -11] KErrAlreadyExists")), 
+						"Error code in the message")
+		self.assertTrue(not E32DbBackend.already_exists(OSError(-110, "Unknown error")), 
+						"Other code with the same digits")
+		self.assertTrue(not E32DbBackend.already_exists(Exception("Table of 11 rows")), 
+						"Message without code")
+	
+	def baseline_tests(self):
+		db_helper = self.create_db_helper(BaselineDbHelper)
+		musics = [(u"E:\\\\Music\\01.mp3", u"Muse", u"Absolution"), 
+				(u"E:\\Music\\02.mp3", u"Muse", u"Absolution"), 
+				(u"E:\\Music\\03.mp3", None, None)]
+		for music in musics:
+			db_helper.execute_nonquery("INSERT INTO Music (Path, Artist, Album) VALUES(?, ?, ?)", music)
+		cmd = "INSERT INTO Music_History (Artist, Track, PlayedAt, Album, TrackLength) " + \
+			"VALUES(?, ?, ?, ?, ?)"
+		for played_at in [20, 10, 10]:
+			db_helper.execute_nonquery(cmd, (u"Muse", u"Hysteria", played_at, u"Absolution", 227))
+		db_helper.close()
+		
+		db_helper = DbHelper(self.get_test_path("test_library.db"), FileSystemServices())
+		self.assertEquals(len(db_helper.get_migrations()), db_helper.get_schema_version(), 
+						"All the migrations run")
+		
+		rows = db_helper.execute_reader("SELECT Path, ArtistId, AlbumId FROM Music ORDER BY Path")
+		self.assertEquals([u"E:\\Music\\01.mp3", u"E:\\Music\\02.mp3", u"E:\\Music\\03.mp3"], 
+						[row[0] for row in rows], "Root paths without the doubled separator")
+		self.assertEquals(rows[0][1:], rows[1][1:], "Same ids for the same names")
+		self.assertTrue(rows[0][1] != rows[2][1], "Own id for the musics without artist")
+		artists = db_helper.execute_reader("SELECT Name FROM Artist ORDER BY Name")
+		self.assertEquals([u"", u"Muse"], [row[0] for row in artists], "Artist names")
+		
+		paths = SearchIndexRepository(db_helper).find_paths(u"absol")
+		paths.sort()
+		self.assertEquals([u"E:\\Music\\01.mp3", u"E:\\Music\\02.mp3"], paths, "Musics indexed")
+		
+		rows = db_helper.execute_reader("SELECT Id, PlayedAt FROM Music_History ORDER BY Id")
+		self.assertEquals([(1, 10), (2, 10), (3, 20)], [tuple(row) for row in rows], 
+						"One id for each play, in the order they were played")
+		self.assertEquals([0], [row[0] for row in 
+						db_helper.execute_reader("SELECT Seq FROM Journal_Applied")], 
+						"No journaled play applied")
+		self.assertEquals(0, db_helper.execute_reader("SELECT COUNT(*) FROM Music WHERE TitleKey IS NOT NULL")[0][0], 
+						"No title key without title")
+		db_helper.close()
+		
+		db_helper = DbHelper(self.get_test_path("test_library.db"), FileSystemServices())
+		self.assertEquals(3, len(db_helper.execute_reader("SELECT Id FROM Music_History")), 
+						"Nothing migrated twice")
+		db_helper.close()
+
+
+class FakeView(object):
+	def __init__(self, rows, types):
+		self.rows = rows
+		self.types = types
+		self.index = 0
+		self.cols_read = 0
+		self.counts = 0
+	
+	def first_line(self):
+		self.index = 0
+	
+	def get_line(self):
+		pass
+	
+	def next_line(self):
+		self.index += 1
+	
+	def count_line(self):
+		self.counts += 1
+		return len(self.rows)
+	
+	def col_count(self):
+		return len(self.types)
+	
+	def col_type(self, column):
+		return self.types[column - 1]
+	
+	def col(self, column):
+		if self.types[column - 1] == 16:
+			raise Exception("Long binary column")
+		self.cols_read += 1
+		return self.rows[self.index][column - 1]
+
+
+class DbCursorFixture(AspyFixture):
+	def __init__(self):
+		AspyFixture.__init__(self)
+		self.title = "DbCursor tests"
+	
+	def run(self):
+		rows = [[u"a", 1, "x"], [u"b", 2, "y"], [u"c", 3, "z"]]
+		
+		view = FakeView(rows, [12, 5, 16])
+		self.assertEquals([[u"a", 1, None], [u"b", 2, None], [u"c", 3, None]], 
+						list(DbCursor(view)), "Long binary columns read as None")
+		self.assertEquals(6, view.cols_read, "Long binary columns never read")
+		
+		view = FakeView(rows, [12, 5, 12])
+		cursor = DbCursor(view)
+		self.assertEquals(0, view.counts, "Lines not counted by the constructor")
+		self.assertEquals(rows[:2], cursor.fetch_many(2), "First rows fetched")
+		self.assertEquals(rows[2:], cursor.fetch_many(2), "Only the remaining rows fetched")
+		self.assertEquals([], cursor.fetch_many(2), "No more rows")
+		self.assertEquals([], DbCursor(FakeView([], [12])).fetch_all(), "Empty view")
+
+
+class BatchTransactionFixture(DbFixture):
+	def __init__(self):
+		DbFixture.__init__(self)
+		self.title = "BatchTransaction tests"
+	
+	def run(self):
+		self.transaction_tests()
+		self.rebuild_tests()
+	
+	def transaction_tests(self):
+		db_helper = self.create_db_helper()
+		batch = BatchTransaction(db_helper, None)
+		self.insert_artists(batch, [1, 2, 3])
+		batch.rollback()
+		self.assertEquals(0, self.count_artists(db_helper), "All the commands rolled back")
+		
+		self.insert_artists(batch, [1, 2, 3])
+		batch.commit()
+		self.assertEquals(3, self.count_artists(db_helper), "Committed on commit()")
+		batch.rollback()
+		self.assertEquals(3, self.count_artists(db_helper), "Nothing rolled back once committed")
+		
+		batch = BatchTransaction(db_helper, 2)
+		self.insert_artists(batch, [4, 5, 6])
+		batch.rollback()
+		self.assertEquals(5, self.count_artists(db_helper), "Full batches committed")
+		db_helper.close()
+	
+	def rebuild_tests(self):
+		db_helper = self.create_db_helper()
+		repository = MusicRepository(db_helper)
+		repository.save_all([self.create_music(u"E:\\Music\\01.mp3", u"Uprising"), 
+							self.create_music(u"E:\\Music\\02.mp3", u"Resistance")])
+		
+		def removed_card():
+			raise IOError("Card removed")
+			yield u""
+		
+		try:
+			repository.rebuild_library(removed_card())
+			self.assertTrue(False, "Interrupted rebuild")
+		except IOError:
+			pass
+		
+		rows = db_helper.execute_reader("SELECT COUNT(*) FROM Music")
+		self.assertEquals(2, rows[0][0], "Old library kept")
+		self.assertEquals([u"E:\\Music\\01.mp3"], 
+						SearchIndexRepository(db_helper).find_paths(u"uprising"), "Search index kept")
+		self.assertEquals(2, repository.count_all(), "Library stats of the old library")
+		db_helper.close()
+	
+	def insert_artists(self, batch, ids):
+		for artist_id in ids:
+			batch.execute("INSERT INTO Artist (Id, Name) VALUES(?, ?)", (artist_id, u"Muse"))
+	
+	def count_artists(self, db_helper):
+		return db_helper.execute_reader("SELECT COUNT(*) FROM Artist")[0][0]
+
+
+class NameRepositoryFixture(DbFixture):
+	def __init__(self):
+		DbFixture.__init__(self)
+		self.title = "NameRepository tests"
+	
+	def run(self):
+		db_helper = self.create_db_helper()
+		artists = NameRepository(db_helper, "Artist")
+		self.assertEquals(1, artists.save_name(u"Muse"), "First id")
+		self.assertEquals(1, artists.save_name(u"Muse"), "Id of a saved name")
+		self.assertEquals(2, artists.save_name(None), "Id of no name")
+		self.assertEquals(2, artists.save_name(u""), "Empty name same as no name")
+		self.assertEquals(u"", artists.get_name(2), "Name of the id")
+		self.assertEquals([u"", u"Muse"], artists.find_all_names(), "Names saved")
+		
+		artists = NameRepository(db_helper, "Artist")
+		self.assertEquals(1, artists.get_id(u"Muse"), "Ids loaded from the database")
+		self.assertEquals(3, artists.save_name(u"Blur"), "Next id after the loaded ones")
+		
+		artists.delete_unused({3: True})
+		self.assertEquals(None, artists.get_id(u"Muse"), "Unused name forgotten")
+		self.assertEquals(None, artists.get_id(None), "Unused empty name forgotten")
+		self.assertEquals([u"Blur"], artists.find_all_names(), "Unused names deleted")
+		self.assertEquals(4, artists.save_name(u"Muse"), "Ids of deleted names not reused")
+		
+		batch = BatchTransaction(db_helper, None)
+		self.assertEquals(5, artists.save_name(u"Keane", batch), "Id in a transaction")
+		batch.rollback()
+		artists.reset()
+		self.assertEquals(None, artists.get_id(u"Keane"), "Rolled back name forgotten")
+		self.assertEquals(6, artists.save_name(u"Keane"), "Id after the rolled back one")
+		self.assertEquals([u"Blur", u"Keane", u"Muse"], artists.find_all_names(), 
+						"Names after the rollback")
+		db_helper.close()
+
+
+class SearchIndexFixture(DbFixture):
+	def __init__(self):
+		DbFixture.__init__(self)
+		self.title = "SearchIndex tests"
+	
+	def run(self):
+		self.tokenize_tests()
+		self.lookup_tests()
+	
+	def tokenize_tests(self):
+		tokens = SearchIndexRepository.tokenize(u"Bloc Party - Like Eating Glass (Live)")
+		self.assertEquals([u"bloc", u"party", u"like", u"eating", u"glass", u"live"], tokens, 
+						"Words in lower case")
+		self.assertEquals([u"sigur", u"r\xf3s"], SearchIndexRepository.tokenize("Sigur R\xf3s"), 
+						"Latin1 text")
+		self.assertEquals([], SearchIndexRepository.tokenize(None), "No text")
+	
+	def lookup_tests(self):
+		db_helper = self.create_db_helper()
+		search_index = SearchIndexRepository(db_helper)
+		long_word = u"a" * 60
+		search_index.save(u"glass", [u"Like Eating Glass", u"Bloc Party", u"Silent Alarm"])
+		search_index.save(u"banquet", [u"Banquet", u"Bloc Party", u"Silent Alarm"])
+		search_index.save(u"takk", [u"Hopp\xedpolla", u"Sigur R\xf3s", long_word])
+		
+		self.assertEquals([u"banquet", u"glass"], self.find(search_index, u"bloc"), "Whole word")
+		self.assertEquals([u"banquet", u"glass"], self.find(search_index, u"BLO par"), 
+						"Prefixes in any case")
+		self.assertEquals([u"glass"], self.find(search_index, u"bloc glass"), 
+						"Musics with all the words")
+		self.assertEquals([], self.find(search_index, u"bloc takk"), "No music with all the words")
+		self.assertEquals([u"takk"], self.find(search_index, u"r\xf3"), "Latin1 text")
+		self.assertEquals([], self.find(search_index, u"ros"), "Accents kept")
+		self.assertEquals([u"takk"], self.find(search_index, long_word), 
+						"Words longer than a token")
+		self.assertEquals([], self.find(search_index, u" - "), "No words")
+		self.assertEquals(1, len(search_index.find_paths(u"silent", 1)), "Max results")
+		
+		search_index.delete_all([u"glass"])
+		self.assertEquals([u"banquet"], self.find(search_index, u"bloc"), "Deleted music")
+		search_index.clear()
+		self.assertEquals([], self.find(search_index, u"bloc"), "Index cleared")
+		db_helper.close()
+	
+	def find(self, search_index, text):
+		paths = search_index.find_paths(text)
+		paths.sort()
+		return paths
+
+
+class LruCacheFixture(AspyFixture):
+	def __init__(self):
+		AspyFixture.__init__(self)
+		self.title = "LruCache tests"
+	
+	def run(self):
+		cache = LruCache(2)
+		cache.put("a", 1)
+		cache.put("b", 2)
+		self.assertEquals(1, cache.get("a"), "Cached item")
+		cache.put("c", 3)
+		self.assertEquals(None, cache.get("b"), "Least recently used item removed")
+		self.assertEquals(3, cache.get("c"), "New item cached")
+		self.assertEquals(2, len(cache), "Cache limited to its max size")
+		self.assertEquals((2, 1), (cache.hits, cache.misses), "Hits and misses counted")
+		cache.clear()
+		self.assertEquals(None, cache.get("a"), "Cache cleared")
+		
+		cache = LruCache(0)
+		cache.put("a", 1)
+		self.assertEquals(None, cache.get("a"), "Nothing cached without a size")
+		
+
 class HardErrorControllerFixture(AspyFixture):
 	def __init__(self):
 		AspyFixture.__init__(self)
@@ -2436,20 +5366,101 @@ class Id3InfoReaderFixture(AspyFixture):
 		reader = Id3InfoReader(input_a)
 		
 		marker, fp = reader.init_file(input_a)
-		self.assertTrue(marker != "TAG", "Not Id3v1")
+		fp.close()
+		self.assertEquals("ID3", marker, "Id3v2")
+		self.assertEquals(u"Shoot The Runner", reader.title, "Title from v2 frames")
+		self.assertEquals(u"Kasabian", reader.artist, "Artist from v2 frames")
+		
+		frames_v3 = "TIT2\x00\x00\x00\x06\x00\x00\x00Title" + \
+					"TRCK\x00\x00\x00\x05\x00\x00\x003/12" + "\x00" * 20
+		frames = reader.read_v2_frames(frames_v3, 3, 0)
+		self.assertEquals(u"Title", frames["title"], "v2.3 title frame")
+		self.assertEquals(3, reader.text_to_number(frames["number"]), "v2.3 track frame")
+		
+		frames_v2 = "TP1\x00\x00\x0b\x01\xff\xfeA\x00r\x00t\x00\x00\x00"
+		frames = reader.read_v2_frames(frames_v2, 2, 0)
+		self.assertEquals(u"Art", frames["artist"], "v2.2 UTF-16 artist frame")
+		self.assertEquals(0x101, reader.syncsafe_to_int("\x00\x00\x02\x01"), "Syncsafe integer")
+		
+		
+class FakeFile(object):
+	def __init__(self, data):
+		self.data = data
+		self.pos = 0
+	
+	def seek(self, pos):
+		self.pos = pos
+	
+	def read(self, size):
+		result = self.data[self.pos:self.pos + size]
+		self.pos += len(result)
+		return result
+
+
+class MpegInfoReaderFixture(AspyFixture):
+	def __init__(self):
+		AspyFixture.__init__(self)
+		self.title = "MpegInfoReaderFixture"
+	
+	def run(self):
+		header = "\xff\xfb\x90\x00" # MPEG 1 layer III, 128 kbps, 44100 Hz, stereo
 		
-		reader = Id3InfoReader(input_a)
-		title = reader.title
-		self.assertEquals("Runner", title[-6:], "Uses the file name if v2")
+		reader = MpegInfoReader(FakeFile("\x00" * 10 + header), 10, 1600000)
+		self.assertEquals(100, reader.length, "CBR length estimated from the bitrate")
+		self.assertTrue(not reader.from_vbr_header, "CBR length")
 		
+		xing = header + "\x00" * 32 + "Xing\x00\x00\x00\x01\x00\x00\x13\x88"
+		reader = MpegInfoReader(FakeFile(xing), 0, 1600000)
+		self.assertEquals(130, reader.length, "Length from the Xing frames count")
+		self.assertTrue(reader.from_vbr_header, "VBR length")
 		
+		reader = MpegInfoReader(FakeFile("\x00" * 100), 0, 100)
+		self.assertEquals(0, reader.length, "No frame header found")
+
+
+class MusicTagsReaderFixture(AspyFixture):
+	def __init__(self):
+		AspyFixture.__init__(self)
+		self.title = "MusicTagsReaderFixture"
+	
+	def run(self):
+		queue = BlockingQueue(2)
+		queue.put(1)
+		queue.put(2)
+		self.assertEquals(1, queue.get(), "First in, first out")
+		self.assertEquals(2, queue.get(), "Second item")
+		
+		music_path = "E:\\Music\\Bloc Party - Silent Alarm\\01 - Like Eating Glass.mp3"
+		paths = [music_path] * 10 + ["E:\\Music\\Testing\\not found.mp3"] * 3
+		for workers in [1, 3]:
+			musics = []
+			errors = []
+			reader = MusicTagsReader(workers, 2)
+			result = reader.read_all(paths, musics.append, lambda path, error: errors.append(path))
+			self.assertEquals(10, result, "Musics read with %i workers" % workers)
+			self.assertEquals(10, len(musics), "Music handler calls with %i workers" % workers)
+			self.assertEquals(3, len(errors), "Error handler calls with %i workers" % workers)
+
+
 class AspyFixtures(object):
 	def __init__(self):
 		self.tests = [
 			MusicFixture(),
 			MusicPlayerFixture(),
 			MusicListFixture(),
+			MusicCatalogFixture(),
+			MusicPagingFixture(),
+			MissingMusicsFixture(),
+			MigrationsFixture(),
+			BatchTransactionFixture(),
+			NameRepositoryFixture(),
+			LruCacheFixture(),
+			SearchIndexFixture(),
+			DbCursorFixture(),
 			MusicHistoryFixture(),
+			ScrobbleSubmitterFixture(),
+			HttpConnectionPoolFixture(),
+			NowPlayingDispatcherFixture(),
 			UserFixture(),
 			AudioScrobblerUserRepositoryFixture(),
 			MusicHistoryRepositoryFixture(),
@@ -2459,7 +5470,9 @@ class AspyFixtures(object):
 			#PlayerUI,
 			HardErrorControllerFixture(),
 			UnicodeHelperFixture(),
-			Id3InfoReaderFixture()
+			Id3InfoReaderFixture(),
+			MpegInfoReaderFixture(),
+			MusicTagsReaderFixture()
 		]
 		
 	def run(self):